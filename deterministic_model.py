@@ -10,6 +10,8 @@ Original file is located at
 import numpy as np 
 import matplotlib.pyplot as plt 
 from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult, least_squares
+import os
 
 import matplotlib as mpl
 
@@ -39,6 +41,334 @@ def seiurf(t, y, b1, b2, d1, d2, g1, g2, d):
                      i*g1 + u*g2,
                      i*d])
 
+"""# Stochastic simulation of the SEIURF rates
+
+The rates of `seiurf` also define a Markov jump process on the integer counts: each term is the rate of an event that
+moves one individual between two compartments. `solve_stochastic` simulates this process, either exactly with
+Gillespie's direct method (`method='gillespie'`) or with adaptive tau-leaping (`method='tau-leap'`, Cao, Gillespie &
+Petzold 2006), which fires many events per step and stays fast for populations of millions. It is called like
+`solve_ivp` and returns the same kind of result, sampled on a daily grid.
+"""
+
+# change of (s, e, i, u, r, f) caused by each event of seiurf_rates
+seiurf_stoichiometry = np.array([[-1, 1, 0, 0, 0, 0], # infection by a symptomatic individual
+                                 [-1, 1, 0, 0, 0, 0], # infection by an exposed or undetected individual
+                                 [0, -1, 1, 0, 0, 0], # exposed becomes symptomatic
+                                 [0, -1, 0, 1, 0, 0], # exposed becomes undetected
+                                 [0, 0, -1, 0, 1, 0], # symptomatic recovers
+                                 [0, 0, 0, -1, 1, 0], # undetected recovers
+                                 [0, 0, -1, 0, 0, 1]]) # symptomatic dies
+
+def seiurf_rates(t, y, b1, b2, d1, d2, g1, g2, d):
+    '''
+    rates of the events of the SEIURF jump process (the rows of seiurf_stoichiometry), with the same
+    inputs as seiurf; seiurf(t, y, ...) is seiurf_stoichiometry.T @ seiurf_rates(t, y, ...)
+    '''
+    s, e, i, u, r, f = y
+    n = np.sum(y)
+    
+    return np.array([b1*s*i/n,
+                     b2*s*(u+e)/n,
+                     e*d1,
+                     e*d2,
+                     i*g1,
+                     u*g2,
+                     i*d])
+
+def solve_stochastic(fun, t_span, y0, args=(), method='gillespie', t_eval=None, seed=None,
+                     epsilon=0.03, n_critical=10):
+    '''
+    Inputs: fun returns the event rates (like seiurf_rates) of the events in seiurf_stoichiometry;
+            t_span, y0 and args are as in solve_ivp (y0 is rounded to integer counts);
+            method is 'gillespie' (exact) or 'tau-leap' (approximate, for large populations);
+            t_eval are the times the state is reported at (default: every day of t_span);
+            seed seeds the random number generator;
+            epsilon bounds the relative change of the rates within a tau-leaping step, and events that
+            could empty their compartment in fewer than n_critical firings are simulated exactly
+    Returns: an OptimizeResult with the times t and the states y (6 x len(t)), as from solve_ivp
+    '''
+    if method not in ('gillespie', 'tau-leap'):
+        raise ValueError(f"method must be 'gillespie' or 'tau-leap', not {method!r}")
+    
+    rng = np.random.default_rng(seed)
+    t0, t1 = t_span
+    t_eval = np.arange(t0, t1 + 1) if t_eval is None else np.asarray(t_eval)
+    stoichiometry = seiurf_stoichiometry
+    reactant = np.argmin(stoichiometry, axis=1) # compartment each event takes an individual from
+    
+    y = np.rint(y0).astype(np.int64)
+    ys = np.empty((len(y), len(t_eval)))
+    t, k, n_steps = t0, 0, 0 # time, index of the next report, and number of steps
+    
+    while k < len(t_eval):
+        rates = fun(t, y, *args)
+        total = rates.sum()
+        n_steps += 1
+        
+        # once no event can happen the state stays the same
+        if total <= 0:
+            ys[:, k:] = y[:, None]
+            break
+        
+        if method == 'tau-leap':
+            # events that could empty their compartment within a step are critical
+            critical = (rates > 0) & (y[reactant] < n_critical)
+            
+            # largest step that keeps the expected relative change of every compartment below epsilon
+            # (all events are at most second order)
+            mean_change = stoichiometry.T @ np.where(critical, 0, rates)
+            var_change = (stoichiometry.T**2) @ np.where(critical, 0, rates)
+            bound = np.maximum(epsilon*y/2, 1)
+            with np.errstate(divide='ignore'):
+                tau = min(np.min(np.where(mean_change != 0, bound/np.abs(mean_change), np.inf)),
+                          np.min(np.where(var_change != 0, bound**2/var_change, np.inf)))
+            
+            # leaping only pays off if the step spans many events, otherwise step exactly
+            if tau > 10/total:
+                total_critical = rates[critical].sum()
+                tau_critical = rng.exponential(1/total_critical) if total_critical > 0 else np.inf
+                while True:
+                    step = min(tau, tau_critical, t_eval[k] - t)
+                    fired = np.where(critical, 0, rng.poisson(np.where(critical, 0, rates)*step))
+                    if step == tau_critical: # one critical event fires at the end of the step
+                        fired[rng.choice(np.flatnonzero(critical), p=rates[critical]/total_critical)] += 1
+                    y_next = y + stoichiometry.T @ fired
+                    if (y_next >= 0).all():
+                        break
+                    tau /= 2 # too many events fired: retry with a shorter step
+                
+                y, t = y_next, t + step
+                while k < len(t_eval) and t_eval[k] <= t:
+                    ys[:, k] = y
+                    k += 1
+                continue
+        
+        # exact step: time of the next event, reporting the state on the grid until then
+        t = t + rng.exponential(1/total)
+        while k < len(t_eval) and t_eval[k] < t:
+            ys[:, k] = y
+            k += 1
+        if k < len(t_eval):
+            event = min(np.searchsorted(np.cumsum(rates), rng.random()*total, side='right'), len(rates) - 1)
+            y = y + stoichiometry[event]
+    
+    return OptimizeResult(t=t_eval, y=ys, nfev=n_steps, success=True,
+                          message=f'{method} simulation reached the end of the time span')
+
+"""# Age-structured SEIURF
+
+`seiurf_age` couples the SEIURF equations of several age groups through a contact matrix `C`: a susceptible individual
+of age group a is exposed at the rate sum_b C[a, b] * (b1_b * i_b + b2_b * (e_b + u_b)) / n_b, where n_b is the size of
+age group b. The state is an (age groups) x 6 array of the (s, e, i, u, r, f) of each age group, flattened for
+`solve_ivp`, and every parameter can be a scalar or have one value per age group. With a single age group and
+C = [[1]] it is `seiurf`. `seiurf_age_jac` is its exact Jacobian, for the implicit `Radau`, `BDF` and `LSODA` methods.
+"""
+
+def seiurf_age(t, y, C, b1, b2, d1, d2, g1, g2, d):
+    '''
+    Inputs: t is time; y is the flattened (age groups) x 6 array of the seiurf information of each age group;
+            C is the (age groups) x (age groups) contact matrix;
+            b1, b2, d1, d2, g1, g2, d are as in seiurf, with one value per age group or one for all
+    '''
+    s, e, i, u, r, f = y.reshape(len(C), 6).T
+    n = s + e + i + u + r + f # size of each age group
+    force = C @ ((b1*i + b2*(u+e)) / n) # rate at which a susceptible individual of each age group is exposed
+    
+    return np.stack([-force*s,
+                     force*s - e*d1 - e*d2,
+                     e*d1 - i*g1 - i*d,
+                     e*d2 - u*g2,
+                     i*g1 + u*g2,
+                     i*d], axis=1).ravel()
+
+def seiurf_age_jac(t, y, C, b1, b2, d1, d2, g1, g2, d):
+    # Jacobian of seiurf_age with respect to the flattened state, with the same inputs
+    n_ages = len(C)
+    s, e, i, u, r, f = y.reshape(n_ages, 6).T
+    n = s + e + i + u + r + f
+    b1, b2, d1, d2, g1, g2, d = np.broadcast_arrays(b1, b2, d1, d2, g1, g2, d, np.zeros(n_ages))[:-1]
+    weight = (b1*i + b2*(u+e)) / n
+    
+    # derivative of the weight of each age group with respect to its (s, e, i, u, r, f) (n depends on all of them)
+    dweight = (np.stack([0*b1, b2, b1, b2, 0*b1, 0*b1], axis=1) - weight[:, None]) / n[:, None]
+    
+    # derivative of the exposures force*s of each age group with respect to the state of each age group
+    dexposures = s[:, None, None] * C[:, :, None] * dweight[None, :, :]
+    dexposures[np.arange(n_ages), np.arange(n_ages), 0] += C @ weight
+    
+    jac = np.zeros((n_ages, 6, n_ages, 6))
+    jac[:, 0] = -dexposures
+    jac[:, 1] = dexposures
+    
+    # transitions within each age group
+    ages = np.arange(n_ages)
+    jac[ages, 1, ages, 1] -= d1 + d2
+    jac[ages, 2, ages, 1] = d1
+    jac[ages, 2, ages, 2] = -(g1 + d)
+    jac[ages, 3, ages, 1] = d2
+    jac[ages, 3, ages, 3] = -g2
+    jac[ages, 4, ages, 2] = g1
+    jac[ages, 4, ages, 3] = g2
+    jac[ages, 5, ages, 2] = d
+    return jac.reshape(6*n_ages, 6*n_ages)
+
+"""# Batched deterministic solver
+
+`solve_batch` integrates the `seiurf` equations of P parameter sets at once with the classical fixed-step Runge-Kutta
+method (RK4), vectorized over the P systems, so a parameter scan is a few thousand NumPy operations on P x 6 arrays
+instead of P calls to `solve_ivp`. The right-hand side `seiurf_batch` writes into preallocated arrays.
+"""
+
+def seiurf_batch(y, params, out):
+    '''
+    Inputs: y is a 6 x P array of the seiurf information of P systems;
+            params is a 7 x P array of their (b1, b2, d1, d2, g1, g2, d), as in seiurf;
+            out is the 6 x P array the derivatives are written to
+    (the systems are the columns, so that every compartment and parameter is a contiguous row)
+    '''
+    s, e, i, u, r, f = y
+    b1, b2, d1, d2, g1, g2, d = params
+    
+    # exposures, computed in out[0] (and out[1] as scratch) without temporary arrays
+    np.add(u, e, out=out[0]); out[0] *= b2
+    np.multiply(b1, i, out=out[1]); out[0] += out[1]
+    out[0] *= s
+    np.sum(y, axis=0, out=out[1]); out[0] /= out[1]
+    
+    np.multiply(e, d1, out=out[2]); out[3] = e; out[3] *= d2
+    out[1] = out[0]; out[1] -= out[2]; out[1] -= out[3]
+    out[0] *= -1
+    np.multiply(u, g2, out=out[4]); out[3] -= out[4]
+    np.multiply(i, d, out=out[5])
+    out[2] -= out[5]
+    out[4] += i*g1
+    out[2] -= i*g1
+    return out
+
+def solve_batch(params, y0, t_span, steps_per_day=4, block_size=16384):
+    '''
+    Inputs: params is a P x 7 array of (b1, b2, d1, d2, g1, g2, d), one row per system (or a single row for all);
+            y0 is a P x 6 array of initial states (or a single row for all);
+            t_span is the (first, last) day;
+            steps_per_day is the number of RK4 steps per day;
+            block_size is the number of systems integrated together
+    Returns: an OptimizeResult with the days t and the states y (P x len(t) x 6)
+    '''
+    params, y0 = np.atleast_2d(params).astype(float), np.atleast_2d(y0).astype(float)
+    P = max(len(params), len(y0))
+    params, y0 = np.broadcast_to(params, (P, 7)), np.broadcast_to(y0, (P, 6))
+    
+    t = np.arange(t_span[0], t_span[1] + 1)
+    ys = np.empty((P, len(t), 6))
+    h = 1 / steps_per_day
+    
+    # the systems are integrated in blocks small enough for the arrays of a step to stay in the CPU cache
+    for block in range(0, P, block_size):
+        cols = slice(block, block + block_size)
+        p, y = np.ascontiguousarray(params[cols].T), np.array(y0[cols].T, order='C')
+        k1, k2, k3, k4, stage = (np.empty_like(y) for _ in range(5))
+        ys[cols, 0] = y.T
+        for day in range(1, len(t)):
+            for _ in range(steps_per_day):
+                seiurf_batch(y, p, k1)
+                np.multiply(k1, h/2, out=stage); stage += y
+                seiurf_batch(stage, p, k2)
+                np.multiply(k2, h/2, out=stage); stage += y
+                seiurf_batch(stage, p, k3)
+                np.multiply(k3, h, out=stage); stage += y
+                seiurf_batch(stage, p, k4)
+                
+                # y += h/6 * (k1 + 2*k2 + 2*k3 + k4)
+                k2 += k3; k2 *= 2; k1 += k2; k1 += k4; k1 *= h/6
+                y += k1
+            ys[cols, day] = y.T
+    
+    return OptimizeResult(t=t, y=ys, nfev=4*steps_per_day*(len(t)-1), success=True,
+                          message='RK4 integration reached the end of the time span')
+
+"""# Calibration to the agent model
+
+The rates of `seiurf` are worked out by hand from the parameters of the agent model (`agent_rates`). `calibrate` instead
+fits them to the daily censuses of the agent model averaged over realizations, by least squares on the Pearson
+residuals (model - data) / sqrt(data), which approximates the maximum likelihood fit for Poisson-distributed counts.
+The rates are fitted on a log scale so that they stay positive. Every ODE solution is memoized per parameter vector in
+`seiurf_solutions`, and the finite-difference Jacobian of each iteration is computed from one `solve_batch` call that
+evaluates all perturbed parameter vectors together.
+"""
+
+seiurf_param_names = ['b1', 'b2', 'd1', 'd2', 'g1', 'g2', 'd']
+seiurf_solutions = {} # memoized daily trajectories by (parameters, initial state, number of days)
+
+def agent_rates(nc1_lam, nc2_lam, incubate_time, min_infect, max_infect, p_e, p_i, p_f, **other_params):
+    '''
+    rates (b1, b2, d1, d2, g1, g2, d) of seiurf that match the parameters of the agent model on average:
+    b1 is the exposure rate of symptomatic ('i') individuals, who make nc2_lam contacts per day, and b2 the one
+    of exposed and undetected individuals, who make nc1_lam contacts per day; the other rates are the inverses
+    of the mean durations (the agent model incubates for at least one day)
+    the other parameters of the agent model (e.g. n, from get_params in its notebook) do not change the rates
+    '''
+    avg_incubate = max(incubate_time, 1)
+    avg_recover = (max_infect + min_infect)/2
+    return np.array([nc2_lam * p_e,
+                     nc1_lam * p_e,
+                     p_i / avg_incubate,
+                     (1 - p_i) / avg_incubate,
+                     (1 - p_f) / avg_recover,
+                     1 / avg_recover,
+                     p_f / avg_recover])
+
+def solve_memoized(params, y0, n_days):
+    '''
+    daily trajectories (P x n_days+1 x 6) of seiurf for the parameter vectors in the rows of params, starting
+    from y0; the ones that are not in seiurf_solutions yet are solved together by solve_batch
+    '''
+    params, y0 = np.atleast_2d(np.asarray(params, dtype=float)), np.asarray(y0, dtype=float)
+    keys = [(row.tobytes(), y0.tobytes(), n_days) for row in params]
+    missing = list({key: k for k, key in enumerate(keys) if key not in seiurf_solutions}.items())
+    if missing:
+        sol = solve_batch(params[[k for key, k in missing]], y0, [0, n_days])
+        for (key, k), y in zip(missing, sol.y):
+            seiurf_solutions[key] = y
+    return np.stack([seiurf_solutions[key] for key in keys])
+
+def calibrate(target, x0, y0=None, fixed=(), weights='pearson', step=1e-4):
+    '''
+    Inputs: target is a T x 6 array of the (s, e, i, u, r, f) of the agent model averaged over realizations,
+            one row per day starting from day 0;
+            x0 is the initial guess of (b1, b2, d1, d2, g1, g2, d), e.g. from agent_rates;
+            y0 is the initial state (default: the first row of target);
+            fixed are the names of the rates that keep their value from x0;
+            weights is 'pearson' to divide the residuals by sqrt(target) or None for plain least squares;
+            step is the step of the finite differences on the log scale
+    Returns: the OptimizeResult of scipy.optimize.least_squares, with the fitted rates in `params`
+             (as a dictionary) and the fitted trajectory in `y` (T x 6)
+    '''
+    target = np.asarray(target, dtype=float)
+    y0 = target[0] if y0 is None else np.asarray(y0, dtype=float)
+    n_days = len(target) - 1
+    x0 = np.asarray(x0, dtype=float)
+    free = [k for k, name in enumerate(seiurf_param_names) if name not in fixed]
+    scale = np.sqrt(np.maximum(target, 1)) if weights == 'pearson' else np.ones_like(target)
+    
+    def params_of(z):
+        # rates from the logarithms z of the free ones, one parameter vector per row of z
+        params = np.tile(x0, (len(z), 1))
+        params[:, free] = np.exp(z)
+        return params
+    
+    def residuals(z):
+        return ((solve_memoized(params_of(z[None]), y0, n_days)[0] - target) / scale).ravel()
+    
+    def jacobian(z):
+        # forward differences, all perturbed parameter vectors solved in one batch
+        y = solve_memoized(params_of(z + np.vstack([np.zeros(len(z)), step*np.eye(len(z))])), y0, n_days)
+        return ((y[1:] - y[0]) / (step*scale)).reshape(len(z), -1).T
+    
+    fit = least_squares(residuals, np.log(np.maximum(x0[free], 1e-9)), jac=jacobian, method='trf')
+    fit.params = dict(zip(seiurf_param_names, params_of(fit.x[None])[0]))
+    fit.y = solve_memoized(params_of(fit.x[None]), y0, n_days)[0]
+    return fit
+
 """# Random guessing of parameters :("""
 
 # initical conditions to test
@@ -95,21 +425,10 @@ p_f = 3.3/100    # prob of a fatality (assuming only symptomatic individuals may
 n = 10000
 y0 = np.array([n-1, 0, 1, 0, 0, 0])
 
-# avg contact per day (times probability of becoming exposed)
-b1 = nc1_lam * p_e 
-b2 = nc2_lam * p_e
-
-# avg per day (divide by 2 since incubation is 2 days)
-d1 = p_i / incubate_time
-d2 = p_u / incubate_time
-
-# recovery rate (on avg recover after 10 days)
-avg_recover = (max_infect + min_infect)/2 
-g1 = (1 - p_f) / avg_recover 
-g2 = 1 / avg_recover 
-
-# death rate
-d = p_f / avg_recover
+# rates that match the stochastic model on average (see agent_rates): avg contact per day (times probability of
+# becoming exposed) of symptomatic (b1) and of exposed and undetected (b2) people, the rates of leaving incubation
+# (d1, d2), the recovery rates (g1, g2) and the death rate (d)
+b1, b2, d1, d2, g1, g2, d = agent_rates(nc1_lam, nc2_lam, incubate_time, min_infect, max_infect, p_e, p_i, p_f)
 
 print(b1, b2, d1, d2, g1, g2, d)
 
@@ -138,74 +457,82 @@ sol.y[5][-1]
 # Percent of population infected
 sol.y[0][-1]
 
-"""# Age stratified attempt (disregard for now)"""
+# stochastic realization of the same rates (exact; use method = 'tau-leap' for populations of millions)
+sol_stochastic = solve_stochastic(seiurf_rates, [0, 90], y0, args=(b1, b2, d1, d2, g1, g2, d), method = 'gillespie')
 
-# initical conditions to test
+fig = plt.figure(); ax = fig.gca()
+curves = ax.plot(sol_stochastic.t, sol_stochastic.y.T)
+ax.legend(curves, ['S', 'E', 'I', 'U', 'R', 'F']);
+ax.set_ylabel('Population');
+ax.set_xlabel('Time (days)');
+ax.set_title('Evolution of Population (Stochastic)');
+
+# scan of the contact rate of symptomatic individuals, all solved at once
+b1_scan = np.linspace(0, 1, 1000) * p_e
+params = np.tile([b1, b2, d1, d2, g1, g2, d], (len(b1_scan), 1))
+params[:, 0] = b1_scan
+sol_scan = solve_batch(params, y0, [0, 90])
+
+fig = plt.figure(); ax = fig.gca()
+ax.plot(b1_scan, sol_scan.y[:, -1, 5])
+ax.set_ylabel('Fatalities after 90 days');
+ax.set_xlabel('b1');
+ax.set_title('Fatalities vs b1 (Deterministic)');
+
+# calibration to the agent model, from its daily censuses averaged over realizations, saved in the agent model
+# notebook with np.save('agent_average.npy', average_over_realizations(100, seed=0)[1])
+if os.path.exists('agent_average.npy'):
+    target = np.load('agent_average.npy')
+    fit = calibrate(target, agent_rates(nc1_lam, nc2_lam, incubate_time, min_infect, max_infect, p_e, p_i, p_f))
+    print(fit.params)
+    
+    fig = plt.figure(); ax = fig.gca()
+    curves = ax.plot(target, '.')
+    ax.set_prop_cycle(None)
+    ax.plot(fit.y)
+    ax.legend(curves, ['S', 'E', 'I', 'U', 'R', 'F']);
+    ax.set_ylabel('Population');
+    ax.set_xlabel('Time (days)');
+    ax.set_title('Calibrated Deterministic Model (lines) vs Agent Model (dots)');
+
+"""# Age stratified model"""
+
+# initical conditions to test: 4 age groups of 10000, each with one infected individual
+age_groups = ['Children', 'Young Adult', 'Adult', 'Elderly']
 n = 10000
-y0 = np.array([n-1, 0, 1, 0, 0, 0])
+y0 = np.tile([n-1, 0, 1, 0, 0, 0], (len(age_groups), 1))
 
 p_e = 0.3
 
-# avg contact per day (times probability of becoming exposed)
-b1_child = 2 * p_e
-b1_ya = 1.5 * p_e
-b1_adult = 1 * p_e
-b1_elderly = 0.8 * p_e
-b2 = 0.5 * p_e
+# avg contact per day of each age group, mixing in proportion to the contacts of the other age groups
+activity = np.array([2, 1.5, 1, 0.8])
+n_by_age = y0.sum(axis=1)
+C = np.outer(activity, activity * n_by_age) / (activity @ n_by_age)
+
+# avg contact per day (times probability of becoming exposed) of symptomatic (b1) and of exposed and undetected (b2)
+# people, the same mapping as agent_rates
+b1 = 0.5 * p_e
+b2 = 1 * p_e
 
 # avg per day (divide by 2 since incubation is 2 days)
-d1_child = 0.2 / 2 # 0.4, 0.6, 0.8
-d1_ya = 0.4 / 2
-d1_adult = 0.6 / 2
-d1_elderly = 0.8 / 2
-d2_child = 1/2 - d1_child
-d2_ya = 1/2 - d1_ya
-d2_adult = 1/2 - d1_adult
-d2_elderly = 1/2 - d1_elderly
+d1 = np.array([0.2, 0.4, 0.6, 0.8]) / 2
+d2 = 1/2 - d1
 
 # recovery rate (on avg recover after 10 days)
 g1 = 1/10
 g2 = 1/10
 
 # death rate
-d_child = 0.001 / 10
-d_ya = 0.0025 / 10
-d_adult = 0.0033 / 10
-d_elderly = 0.013 / 10
-
-# solutions (non-stiff)
-sol_child = solve_ivp(seiurf, [0, 100], y0, args=(b1_child, b2, d1_child, d2_child, g1, g2, d_child), method = 'RK45')
-sol_ya = solve_ivp(seiurf, [0, 100], y0, args=(b1_ya, b2, d1_ya, d2_ya, g1, g2, d_ya), method = 'RK45')
-sol_adult = solve_ivp(seiurf, [0, 100], y0, args=(b1_adult, b2, d1_adult, d2_adult, g1, g2, d_adult), method = 'RK45')
-sol_elderly = solve_ivp(seiurf, [0, 100], y0, args=(b1_elderly, b2, d1_elderly, d2_elderly, g1, g2, d_elderly), method = 'RK45')
-
-# solutions (stiff)
-# sol = solve_ivp(seiurf, [0, 100], y0, args=(b1, b2, d1, d2, g1, g2, d), method = 'Radau')
-
-fig = plt.figure(); ax = fig.gca()
-curves = ax.plot(sol_child.t, sol_child.y.T)
-ax.legend(curves, ['S', 'E', 'I', 'U', 'R', 'F']);
-ax.set_ylabel('Population');
-ax.set_xlabel('Time (days)');
-ax.set_title('Evolution of Population (Deterministic)\n Children');
-
-fig = plt.figure(); ax = fig.gca()
-curves = ax.plot(sol_ya.t, sol_ya.y.T)
-ax.legend(curves, ['S', 'E', 'I', 'U', 'R', 'F']);
-ax.set_ylabel('Population');
-ax.set_xlabel('Time (days)');
-ax.set_title('Evolution of Population (Deterministic)\n Young Adult');
-
-fig = plt.figure(); ax = fig.gca()
-curves = ax.plot(sol_adult.t, sol_adult.y.T)
-ax.legend(curves, ['S', 'E', 'I', 'U', 'R', 'F']);
-ax.set_ylabel('Population');
-ax.set_xlabel('Time (days)');
-ax.set_title('Evolution of Population (Deterministic)\n Adult');
-
-fig = plt.figure(); ax = fig.gca()
-curves = ax.plot(sol_elderly.t, sol_elderly.y.T)
-ax.legend(curves, ['S', 'E', 'I', 'U', 'R', 'F']);
-ax.set_ylabel('Population');
-ax.set_xlabel('Time (days)');
-ax.set_title('Evolution of Population (Deterministic)\n Elderly');
\ No newline at end of file
+d = np.array([0.001, 0.0025, 0.0033, 0.013]) / 10
+
+# solutions (stiff, all age groups in one system)
+sol = solve_ivp(seiurf_age, [0, 100], y0.ravel(), args=(C, b1, b2, d1, d2, g1, g2, d), method = 'Radau', jac = seiurf_age_jac)
+y_by_age = sol.y.reshape(len(age_groups), 6, -1)
+
+for age, y in zip(age_groups, y_by_age):
+    fig = plt.figure(); ax = fig.gca()
+    curves = ax.plot(sol.t, y.T)
+    ax.legend(curves, ['S', 'E', 'I', 'U', 'R', 'F']);
+    ax.set_ylabel('Population');
+    ax.set_xlabel('Time (days)');
+    ax.set_title(f'Evolution of Population (Deterministic)\n {age}');
\ No newline at end of file
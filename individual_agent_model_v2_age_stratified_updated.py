@@ -9,8 +9,9 @@ Original file is located at
 
 import numpy as np
 import matplotlib.pyplot as plt
-import random
 from collections import defaultdict
+import os
+import json
 
 """### Helpful Resources
 
@@ -121,301 +122,285 @@ plot_realizations(10)
 
 """# Functions"""
 
-def simulate1D():
+def simulate1D(checkpoint=None, checkpoint_every=30, seed=None):
     """
     this function packages the simulation steps of intializing the population
     vector and iterating the epidemic and census functions unit I=0
-    the censuses are accumulated in a matrix, results
+    the censuses are accumulated in a matrix, results, and the censuses of each
+    age group in a T x n_ages x 6 integer array, results_by_age
+    with a seed, np.random is seeded with it first
+    with a checkpoint path, the state of the simulation is saved there every checkpoint_every
+    days, and if the file already exists the simulation resumes from it, after checking that it was
+    saved with the same global variables and seed (see load_checkpoint); the file is removed once the
+    simulation is complete, so a later simulation does not resume from it
     """
-    t=0 # counts number of days, starting from the 0th day
-    pop=initial1D(n,0,0,0,0,0) # initial susceptible, exposed, infected, recovered, and undetected
-    
-    # dictionaries to keep track how many days are left before an individual's 'e', 'i', or 'u' state will change
-    t_e = {} # days left of the exposed/incubation period
-    t_i = {} # days left for the infected period
-    t_u = {} # days left for the undetected period
-    ages = age_of_each_ind(len(pop))
+    if checkpoint is not None and os.path.exists(checkpoint):
+        t, pop, ages, days_left, active, alive, results_by_age = load_checkpoint(checkpoint, seed)
+    else:
+        if seed is not None:
+            np.random.seed(seed)
+        t=0 # counts number of days, starting from the 0th day
+        pop=initial1D(n,0,0,0,0,0) # initial susceptible, exposed, infected, recovered, and undetected
+        
+        # days left before an individual's 'e', 'i', or 'u' state will change (0 for every other state)
+        days_left = np.zeros(n, dtype=np.int16)
+        ages = age_of_each_ind(len(pop))
+        
+        pop[int(n/2)-1]=I_CODE # 1 infection to start with
+        days_left[int(n/2)-1]=int(np.random.uniform(min_infect,max_infect)) # add number of days left the individual has of being infected
+        active=np.array([int(n/2)-1]) # indices of the 'e', 'i', and 'u' individuals
+        alive=new_alive(n) # individuals that can be contacted, see epidemic1D_age
+        
+        # per-age censuses, preallocated and doubled in length whenever the epidemic outlasts them
+        results_by_age = np.zeros((256, len(age_groups), 6), dtype=np.int64)
+        results_by_age[0] = census1D_by_age(ages, pop)
     
-    pop[int(n/2)-1]='i' # 1 infection to start with
-    t_i[int(n/2)-1]=int(np.random.uniform(min_infect,max_infect)) # add number of days left the individual has of being infected
-
-    s,e,i,u,r,f=census1D(pop) # get the number of individuals in each state
-    results=[[s,e,i,u,r,f]] # add starting populations into an array
-    results_by_age = [group_states_by_age(ages, pop)]
-    tt=[t] # keep track of the timesteps
+    results=results_by_age[:t+1].sum(axis=1).tolist() # add populations so far into an array
+    s,e,i,u,r,f=results[-1] # get the number of individuals in each state
+    tt=list(range(t+1)) # keep track of the timesteps
     
     # as long as there is an exposed, infected, or undetected individual, the infection will continue to spread
     while e>0 or i>0 or u>0:
-        # pass population as well as dictionaries (days each e, i, u individual have left in their current state)
-        pop, t_e, t_i, t_u=epidemic1D_age(pop, ages, t_e, t_i, t_u) 
-        
-        states_by_age_in_timestep = group_states_by_age(ages, pop)
-        results_by_age.append(states_by_age_in_timestep)
-        
-        s,e,i,u,r,f=census1D(pop) # get the number of individuals in each state
-        results.append([s,e,i,u,r,f]) # add current population into an array
-        
+        # pass population, the days each e, i, u individual has left in their current state and their indices
+        pop, days_left, active=epidemic1D_age(pop, ages, days_left, active, alive)
         
         # update time
         t=t+1
         tt.append(t)
         
+        if t == len(results_by_age):
+            results_by_age = np.concatenate([results_by_age, np.zeros_like(results_by_age)])
+        results_by_age[t] = census1D_by_age(ages, pop)
+        
+        s,e,i,u,r,f=results_by_age[t].sum(axis=0).tolist() # get the number of individuals in each state
+        results.append([s,e,i,u,r,f]) # add current population into an array
+        
+        if checkpoint is not None and t % checkpoint_every == 0:
+            save_checkpoint(checkpoint, t, pop, ages, days_left, active, alive, results_by_age, seed)
+    
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint) # the simulation is complete
+        
     # return time and results
-    return tt,results, results_by_age
+    return tt,results, results_by_age[:t+1]
 
-def group_states_by_age(ages, pop):
-    """
-    this function, when passed in a list of age groups and a list of states corresponding to each individual
-    in the population, returns a dictionary where the key is the age group and the value is a list containing
-    counts of the number of people in that age group that correspond to each state s,e,i,u,r,f respectively
-    """
-    # create list of tuples where first elem is age of ind. and second elem is state of ind. at current timestep
-    ages_states_zipped = list(zip(ages, pop))
-
-    # group ages_states_zipped by age to get total in each state by age
-    # returned dict has key of age, value is a list containing the number of individuals of that age 
-    # in each given state at timestep        
-    states_by_age_in_timestep = {}
-    for (age_iter, state_iter) in ages_states_zipped:
-        if states_by_age_in_timestep.get(age_iter) == None:
-            states_by_age_in_timestep[age_iter] = [state_iter]
-        else:
-            states_by_age_in_timestep[age_iter].append(state_iter)
-    
-    final_dict = {}
-    for age_group in list(states_by_age_in_timestep.keys()):
-        try:
-            stats_per_group = census1D(states_by_age_in_timestep[age_group])
-            final_dict[age_group] = stats_per_group
-        except:
-            final_dict[age_group] = [(0,0,0,0,0,0)]
-    return final_dict
+# global variables that define the model, stored in a checkpoint
+checkpoint_params = ['n', 'nc2_lam', 'incubate_time', 'min_infect', 'max_infect',
+                     'pi_children', 'pi_young_adult', 'pi_adult', 'pi_elderly',
+                     'age_cutoffs', 'nc1_lam_by_age', 'p_e_values', 'p_e_weights_by_age', 'p_f_range_by_age']
+
+def params_record():
+    # values of the checkpoint_params, as they are stored in a checkpoint
+    return {name: np.asarray(globals()[name]).tolist() for name in checkpoint_params}
+
+def save_checkpoint(path, t, pop, ages, days_left, active, alive, results_by_age, seed=None):
+    '''
+    saves the state of simulate1D on day t to a compressed .npz file: the state, age code, days left and
+    alive set of every individual, the indices of the 'e', 'i', and 'u' individuals, the per-age censuses
+    so far and the state of np.random, so that a simulation resumed from it is bit-identical to one that
+    was not interrupted, and the seed and global variables it was run with, so that it is not resumed
+    with others
+    the previous checkpoint is only replaced once the new one is complete
+    '''
+    generator, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        np.savez_compressed(file, t=t, pop=pop, ages=ages, days_left=days_left, active=active,
+                            alive_index=alive['index'], alive_position=alive['position'], alive_count=alive['count'],
+                            results_by_age=results_by_age[:t+1],
+                            rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss, rng_cached_gaussian=cached_gaussian,
+                            seed=json.dumps(seed), params=json.dumps(params_record()))
+    os.replace(tmp, path)
+
+def load_checkpoint(path, seed=None):
+    '''
+    loads the state saved by save_checkpoint and restores the state of np.random, after checking that it
+    was saved with the current values of the checkpoint_params and (unless seed is None) the same seed;
+    raises a ValueError if not
+    '''
+    with np.load(path) as data:
+        saved = json.loads(str(data['params']))
+        changed = sorted(name for name in set(saved) | set(params_record()) if saved.get(name) != params_record().get(name))
+        if changed:
+            raise ValueError(f'{path} was saved with other values of {", ".join(changed)}: ' +
+                             ', '.join(f'{name} = {saved.get(name)}' for name in changed))
+        if seed is not None and json.loads(str(data['seed'])) != seed:
+            raise ValueError(f'{path} is a checkpoint of a simulation with seed {json.loads(str(data["seed"]))}')
+        
+        np.random.set_state(('MT19937', data['rng_keys'], int(data['rng_pos']), int(data['rng_has_gauss']),
+                             float(data['rng_cached_gaussian'])))
+        alive = {'index': data['alive_index'], 'position': data['alive_position'], 'count': int(data['alive_count'])}
+        t = int(data['t'])
+        
+        # room for the censuses of the remaining days, doubled whenever the epidemic outlasts it
+        results_by_age = np.zeros((2*(t+1), len(age_groups), 6), dtype=np.int64)
+        results_by_age[:t+1] = data['results_by_age']
+        return t, data['pop'], data['ages'], data['days_left'], data['active'], alive, results_by_age
+
+# integer codes of the agent states, in the same order census1D reports them
+S_CODE, E_CODE, I_CODE, U_CODE, R_CODE, F_CODE = range(6)
 
 def initial1D(s0,e0,i0,u0,r0,f0):
     '''
     sets an initial population vector for the epidemic simulation
-    each state subpopulation is appended to the growing vector, pop
+    each state subpopulation is a block of its state code (S_CODE, ..., F_CODE) in the int8 vector pop
     NOTE: if position in the array is important,eg. if you are modeling
     local neighborhood contacts, each individual must be placed 
     randomly in the array
     '''
-    
-    pop=[] # array of individual agent states
-    
-    # add the states of the individual agents into the array
-    for i in range(s0):
-        pop.append('s')
-    for i in range(e0):
-        pop.append('e')
-    for i in range(i0):
-        pop.append('i')
-    for i in range(u0):
-        pop.append('u')
-    for i in range(r0):
-        pop.append('r')
-    for i in range(f0):
-        pop.append('f')
-        
-    # randomizes individuals in array
-    return pop
+    return np.repeat(np.arange(6, dtype=np.int8), [s0, e0, i0, u0, r0, f0])
 
 def census1D(pop):
-    # counts the number of s, e, i, r, u, and f cells in pop
-    s=0 # susceptible
-    e=0 # exposed
-    i=0 # infected
-    u=0 # undetected
-    r=0 # recovered
-    f=0 # fatalities
-    n=np.array(pop).shape[0]
-
-    for j in range(n):
-        if pop[j]=='s':
-            s+=1
-        elif pop[j]=='e':
-            e+=1
-        elif pop[j]=='i':
-            i+=1
-        elif pop[j]=='u':
-            u+=1
-        elif pop[j]=='r':
-            r+=1
-        elif pop[j]=='f':
-            f+=1
+    # counts the number of s, e, i, u, r, and f cells in pop
+    s,e,i,u,r,f = np.bincount(np.asarray(pop, dtype=np.int8), minlength=6).tolist()
     return s,e,i,u,r,f
 
+def census1D_by_age(ages, pop):
+    '''
+    counts the number of s, e, i, u, r, and f cells of each age group in a single 2D bincount over
+    (age code, state code); returns an n_ages x 6 array whose rows are the censuses of the age groups
+    '''
+    return np.bincount(ages*6 + pop, minlength=len(age_groups)*6).reshape(len(age_groups), 6)
+
+"""## Age Lookup Tables
+
+Ages are stored as the integer codes 0-3 of `age_groups`, and every age-based parameter is a NumPy table indexed by
+that code, so the parameters of a whole batch of individuals are looked up with a single fancy index.
+"""
+
+age_groups = ['C', 'Y', 'A', 'E'] # children, young adults, adults, elderly; the index is the age code
+age_cutoffs = np.array([0.25, 0.47, 0.86]) # cumulative share of children, young adults, and adults in the population
+
+nc1_lam_by_age = np.array([2, 1.5, 1, 0.8]) # rate of contacts per day of exposed and undetected people
+
+# the probability of being exposed after contact is drawn for every contact from a mixture of p_e_values,
+# with weights depending on the age of the contacted individual
+p_e_values = np.array([0.1, 0.3])
+p_e_weights_by_age = np.array([[0.3, 0.7],
+                               [0.4, 0.6],
+                               [0.6, 0.4],
+                               [0.7, 0.3]])
+
+#     p_e_values = np.array([0.08, 0.1, 0.2, 0.3])
+#     p_e_weights_by_age = np.array([[0.5, 0.01, 0.44, 0.05],
+#                                    [0.4, 0.05, 0.5, 0.05], # with 0.15 instead of 0.2
+#                                    [0.6, 0.05, 0.3, 0.05], # with 0.15 instead of 0.2
+#                                    [0.7, 0.25, 0.05, 0]])
+
+# the fatality rate of each symptomatic individual is drawn uniformly from the range of their age group
+p_f_range_by_age = np.array([[0, 0.002],
+                             [0.002, 0.003],
+                             [0.003, 0.036],
+                             [0.06, 0.2]])
+
 def age_of_each_ind(pop):
-    
-    pop_age_groups = [''] * pop
-    
-    for ind in range(pop):
-        
-        age_bracket = np.random.rand()
-        if age_bracket <= 0.25:
-            pop_age_groups[ind] = 'C'
-        elif age_bracket > 0.25 and age_bracket <= 0.47:
-            pop_age_groups[ind] = 'Y'
-        elif age_bracket > 0.47 and age_bracket <= 0.86:
-            pop_age_groups[ind] = 'A'
-        else:
-            pop_age_groups[ind] = 'E'
-            
-    return pop_age_groups
-
-def age_based_p_f(age):
-    if age == 'C':
-        p_f = np.random.uniform(0,0.002)
-    elif age == 'Y':
-        p_f = np.random.uniform(0.002,0.003)
-    elif age == 'A':
-        p_f = np.random.uniform(0.003,0.036)
-    else:
-        p_f = np.random.uniform(0.06,0.2)
-    return p_f
-
-def age_based_p_i(age):
-    if age == 'C':
-        p_i = pi_children
-    elif age == 'Y':
-        p_i = pi_young_adult
-    elif age == 'A':
-        p_i = pi_adult
-    else:
-        p_i = pi_elderly
-    return p_i
-
-def age_based_p_e(age):
-    if age == 'C':
-        p_e = random.choices([0.1, 0.3], [0.3, 0.7])[0]
-    elif age == 'Y':
-        p_e = random.choices([0.1, 0.3], [0.4, 0.6])[0]
-    elif age == 'A':
-        p_e = random.choices([0.1, 0.3], [0.6, 0.4])[0]
-    else:
-        p_e = random.choices([0.1, 0.3], [0.7, 0.3])[0]
-
-
-#     if age == 'C':
-#         p_e = random.choices([0.08, 0.1, 0.2, 0.3], [0.5, 0.01, 0.44, 0.05])[0]
-#     elif age == 'Y':
-#         p_e = random.choices([0.08, 0.1, 0.15, 0.3], [0.4, 0.05, 0.5, 0.05])[0]
-#     elif age == 'A':
-#         p_e = random.choices([0.08, 0.1, 0.15, 0.3], [0.6, 0.05, 0.3, 0.05])[0]
-#     else:
-#         p_e = random.choices([0.08, 0.1, 0.2], [0.7, 0.25, 0.05])[0]
-#     p_e = 0.3
-    return p_e
-
-def age_based_nc1_lam(age):
-    if age == 'C':
-        nc1_lam = 2
-    elif age == 'Y':
-        nc1_lam = 1.5
-    elif age == 'A':
-        nc1_lam = 1
-    else:
-        nc1_lam = 0.8
-    return nc1_lam
+    # draws the age code of each of the pop individuals
+    return np.searchsorted(age_cutoffs, np.random.rand(pop)).astype(np.int8)
+
+def p_i_by_age():
+    # table of the symptomatic rates by age code, from the pi_* global variables
+    return np.array([pi_children, pi_young_adult, pi_adult, pi_elderly])
+
+def new_alive(n):
+    '''
+    alive set of a population of n individuals (all alive at first): the indices of the alive individuals
+    are packed in the first `count` entries of `index`, and `position` holds the position of every individual
+    in `index`
+    '''
+    return {'index': np.arange(n), 'position': np.arange(n), 'count': n}
 
-def epidemic1D_age(pop1, ages, t_e, t_i, t_u):
+def remove_alive(alive, idx):
     '''
-    this stochastic epidemic simulation calculates a new pop2
-    vector of 's', 'e', i', 'u', 'r', and 'f' from the current pop1
+    removes the individuals idx from the alive set: the last alive individual is moved into the position
+    of each removed one, so the cost is proportional to the number of fatalities
+    '''
+    index, position = alive['index'], alive['position']
+    for j in idx.tolist():
+        alive['count'] -= 1
+        last = index[alive['count']]
+        index[position[j]] = last
+        position[last] = position[j]
+
+def epidemic1D_age(pop, ages, days_left, active, alive):
+    '''
+    this stochastic epidemic simulation advances the int8 vector pop of S_CODE, E_CODE, I_CODE,
+    U_CODE, R_CODE, and F_CODE states by one day
     
     The number of contacts of the contagious ('e', 'i', 'u') is generated by a poisson distribution. We assume
-    that 'e' and 'u' individuals have the same rate of contacts nc1_lam. However, 'i' individuals have a lower
-    rate of contacts nc2_lam.
+    that 'e' and 'u' individuals have the same rate of contacts nc1_lam, which depends on their age. However,
+    'i' individuals have a lower rate of contacts nc2_lam.
     
-    `t_e`, `t_i`, and `t_u` dictionaries explained:
-    The moment an individual becomes exposed, we add them to dictionary 't_e' with the number of days left that
-    they will remain in that state. After this number becomes 0, we remove them from 't_e' and see whether they
-    become 'i' or 'u', that is symptomatic or asymptomatic, respectively. For 'i' and 'u', we generate the number
-    of days in their respective states from a uniform distribution ranging from `min_infect` to `max_infect`. At
-    the end of the countdown for a symptomatic individual, 'i', they will either recover (with probability p_i)
-    or die (probability p_f = 1-p_i). At the end of the countdown for an asymptomatic individual, 'u', they
-    will recover.
-    '''
-    # initial times in state left
-    t_e2 = t_e.copy()
-    t_i2 = t_i.copy()
-    t_u2 = t_u.copy()
+    `days_left` explained:
+    The moment an individual becomes exposed, we set their entry of the int16 array `days_left` to the number of
+    days left that they will remain in that state. After this number becomes 0, we see whether they become 'i'
+    or 'u', that is symptomatic or asymptomatic, respectively. For 'i' and 'u', we generate the number of days
+    in their respective states from a uniform distribution ranging from `min_infect` to `max_infect`. At the end
+    of the countdown for a symptomatic individual, 'i', they will either recover (with probability p_i) or die
+    (probability p_f = 1-p_i). At the end of the countdown for an asymptomatic individual, 'u', they will recover.
+    All timers are decremented in one operation, and the outcomes of the individuals whose countdown ends are
+    drawn in bulk.
     
-    pop2=pop1.copy() # population after contacts
-    n=np.array(pop1).shape[0]
+    `active` explained:
+    The indices of the 'e', 'i', and 'u' individuals are passed in and returned in the array `active`. Only
+    these individuals make contacts or have a running countdown, so the work per day scales with the number
+    of contagious individuals and their contacts instead of the population size. `pop` and `days_left` are
+    updated in place.
     
+    `alive` explained:
+    Contacts are only made with alive individuals. Their indices are kept packed at the start of an array
+    (see new_alive), so all targets of the day are drawn in one call instead of a rejection loop, and
+    fatalities are removed from it as they occur.
     
-    # iterate through each individual
-    for j in range(n):
-        age_j = ages[j]
-        # if person is exposed or undetected (assumption: they do NOT change behavior, so number of contacts is same)
-        if pop1[j]=='e' or pop1[j]=='u':
-            # number of contacts
-            nc1_lam = age_based_nc1_lam(age_j)
-            nc1 = np.random.poisson(nc1_lam)
-            
-            # generate contacts and with probability p_e, an 's' individual will become 'e'
-            for c in range(nc1):
-                k=j
-                while k==j and pop1[k]!='f': # make sure we only count contacts with a different and alive individual
-                    k=np.random.randint(n)
-                    age_k = ages[k]
-                
-                # see if susceptible person is exposed
-                if pop1[k]=='s' and np.random.rand() < age_based_p_e(age_k):
-                    pop2[k]='e'
-                    t_e2[k] = incubate_time
-        
-        # if person is infected (assumption: they change behavior, so number of contacts is fewer)
-        if pop1[j]=='i':
-            # number of contacts
-            nc2 = np.random.poisson(nc2_lam)
-            
-            # generate contacts and with probability p_e, an 's' individual will become 'e'
-            for c in range(nc2):
-                k=j
-                while k==j and pop1[k]!='f': # make sure we only count contacts with a different and alive individual
-                    k=np.random.randint(n)
-                    age_k = ages[k]
-                
-                # see if susceptible person is exposed
-                if pop1[k]=='s' and np.random.rand() < age_based_p_e(age_k):
-                    pop2[k]='e'
-                    t_e2[k] = incubate_time
+    The age-based parameters of the contacts and transitions come from the age lookup tables, so all contacts
+    and transitions of the day are drawn in a few batched calls.
+    '''
+    # contagious individuals and their number of contacts
+    state = pop[active]
+    lam = np.where(state==I_CODE, nc2_lam, nc1_lam_by_age[ages[active]]) # 'i' individuals change behavior
+    contacts = np.repeat(active, np.random.poisson(lam))
+    
+    # each contact is drawn among the other alive individuals (skipping over the contagious individual itself)
+    if alive['count'] < 2:
+        contacts = contacts[:0] # the last individual alive has no one to contact
+    targets = np.random.randint(max(alive['count'] - 1, 1), size=contacts.size)
+    targets += targets >= alive['position'][contacts]
+    targets = alive['index'][targets]
+    
+    # draw the exposure probability of each contact from the mixture of its age group, and see which
+    # susceptible contacts are exposed
+    # (the component is the number of cumulative weights below a uniform draw, for any number of components)
+    thresholds = np.cumsum(p_e_weights_by_age, axis=1)[:, :-1]
+    component = (np.random.rand(targets.size)[:, None] >= thresholds[ages[targets]]).sum(axis=1)
+    p_e = p_e_values[component]
+    exposed = np.unique(targets[(pop[targets]==S_CODE) & (np.random.rand(targets.size) < p_e)])
         
     # update time left in 'e', 'i', and 'u' states
+    left = days_left[active] - 1
+    days_left[active] = np.maximum(left, 0)
+    done, state = active[left <= 0], state[left <= 0]
+    
+    # exposed individuals at the end of their incubation become symptomatic or asymptomatic
+    done_e = done[state==E_CODE]
+    symptomatic = np.random.rand(done_e.size) < p_i_by_age()[ages[done_e]]
+    pop[done_e] = np.where(symptomatic, I_CODE, U_CODE)
+    days_left[done_e] = np.random.uniform(min_infect, max_infect, size=done_e.size).astype(int)
+    
+    # infected individuals at the end of their countdown die or recover
+    done_i = done[state==I_CODE]
+    p_f_range = p_f_range_by_age[ages[done_i]]
+    fatality = np.random.rand(done_i.size) < np.random.uniform(p_f_range[:, 0], p_f_range[:, 1])
+    pop[done_i] = np.where(fatality, F_CODE, R_CODE)
+    remove_alive(alive, done_i[fatality])
     
-    for key in t_e:
-        time = t_e2.pop(key) - 1
-        age_key_exposed = ages[key]
-        if time > 0:
-            t_e2[key] = time
-        else:
-            if np.random.rand() < age_based_p_i(age_key_exposed): # symptomatic
-                pop2[key] = 'i'
-                t_i2[key] = int(np.random.uniform(min_infect,max_infect))
-            else: # undetected/asymptomatic
-                pop2[key] = 'u'
-                t_u2[key] = int(np.random.uniform(min_infect,max_infect))
-            
-    for key in t_i:
-        time = t_i2.pop(key) - 1
-        age_key_infected = ages[key]
-        if time > 0:
-            t_i2[key] = time
-        else:
-            if np.random.rand() < age_based_p_f(age_key_infected): # fatality
-                pop2[key] = 'f'
-            else: # recovered
-                pop2[key] = 'r'
-                
-    for key in t_u:
-        time = t_u2.pop(key) - 1
-        if time > 0:
-            t_u2[key] = time
-        else: # recovery
-            pop2[key] = 'r'
+    # undetected individuals at the end of their countdown recover
+    pop[done[state==U_CODE]] = R_CODE
+    
+    # newly exposed individuals start their incubation
+    pop[exposed] = E_CODE
+    days_left[exposed] = incubate_time
+    active = np.concatenate([active[left > 0], done_e, exposed])
         
-    return pop2, t_e2, t_i2, t_u2
+    return pop, days_left, active
 
 def plot_realizations(n_realizations):
     '''
@@ -454,9 +439,7 @@ def plot_realizations(n_realizations):
 """## Plot Curves by Age"""
 
 def plot_curves_by_age(age, results_by_age):
-    stats_over_time = []
-    for timestep in results_by_age:
-        stats_over_time.append(timestep[age])
+    stats_over_time = results_by_age[:, age_groups.index(age), :]
         
     age_to_title_str = {'A': 'Adult', 'Y': 'Young Adult', 'E': 'Elderly', 'C': 'Children'}
         
@@ -484,22 +467,17 @@ def compartment_over_time(compartment, results_by_age):
     compartment_to_num = {'s': 0, 'e': 1, 'i': 2, 'u': 3, 'r': 4, 'f': 5}
     num = compartment_to_num[compartment]
     
-    data_over_time = []
-    for timestep in results_by_age:
-        data_over_time.append([item[num] for item in list(timestep.values())])
-    
-    data_by_age = []
-    for i in range(4):
-        data_by_age.append([item[i] for item in data_over_time])
+    # one row per age group, one column per timestep
+    data_by_age = np.transpose(results_by_age[:, :, num])
         
     timerange = range(len(results_by_age))
-    plt.stackplot(timerange, data_by_age[0], data_by_age[1], data_by_age[2], data_by_age[3]);
+    plt.stackplot(timerange, *data_by_age);
     compartment_to_title_str = {'s': 'Susceptible', 'e': 'Exposed', 'i': 'Infected', 
                                 'u': 'Undetected', 'r': 'Recovered', 'f': 'Deceased'}
     
     age_to_title_str = {'A': 'Adult', 'Y': 'Young Adult', 'E': 'Elderly', 'C': 'Children'}
     legend_list = []
-    for age_group in results_by_age[0].keys():
+    for age_group in age_groups:
         legend_list.append(age_to_title_str[age_group])
     
     plt.legend(legend_list);
@@ -521,30 +499,28 @@ compartment_over_time('f', results_by_age)
 
 """## Average Data Over Realizations"""
 
-def average_over_realizations(n_realizations):
-     # Create dictionaries to store the times and results of each realization
-    tts = {}
-    results = {}
-    results_by_age = {}
-
+def average_over_realizations(n_realizations, by_age=False):
+    '''
+    averages the per-age censuses of n_realizations realizations; shorter realizations are
+    padded with their last census. Returns the T x 6 average of the totals, or the
+    T x n_ages x 6 average of each age group if by_age is True
+    '''
     # Simulate n_realizations given the p, nc, pt values passed to the function
-    for i in range(n_realizations):
-        tts[i], results[i], results_by_age[i] = simulate1D()
-        
-    timesteps_per_realization = []
-    for n in range(n_realizations):
-        timesteps_per_realization.append(len(list(results.values())[n]))
+    results_by_age = [simulate1D()[2] for i in range(n_realizations)]
     
-    max_num_timesteps = max(timesteps_per_realization)
-        
-    for n in range(n_realizations):
-        if len(results[n]) < max_num_timesteps:
-            new_val = results[n] + [results[n][-1]]*(max_num_timesteps - len(results[n]))
-            results[n] = new_val
+    max_num_timesteps = max(len(realization) for realization in results_by_age)
+    
+    # add up the padded realizations in a single T x n_ages x 6 array
+    sum_over_realizations = np.zeros((max_num_timesteps, len(age_groups), 6))
+    for realization in results_by_age:
+        sum_over_realizations[:len(realization)] += realization
+        sum_over_realizations[len(realization):] += realization[-1]
     
-    avg_over_realizations = np.average(np.array(list(results.values())), axis = 0)
+    avg_over_realizations = sum_over_realizations / n_realizations
     
-    return avg_over_realizations
+    if by_age:
+        return avg_over_realizations
+    return avg_over_realizations.sum(axis=1)
 
 averaged_data = average_over_realizations(5)
 
@@ -14,6 +14,15 @@ import matplotlib.pyplot as plt
 import random
 from collections import defaultdict
 import pandas as pd
+import os
+import json
+import hashlib
+import zipfile
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from scipy.integrate import solve_ivp
+from scipy.special import gammaincinv, gammaln, stdtrit, ndtri
 
 import matplotlib as mpl
 
@@ -98,6 +107,13 @@ p_i = 0.484   # prob of becoming symptomatic / infected
 p_u = 1 - p_i # prob of becoming asymptomatic (undetected)
 p_f = 2.6605/100    # prob of a fatality (assuming only symptomatic individuals may die)
 
+# shapes of the duration distributions of the vectorized engine (0 for the constant incubate_time and the uniform
+# min_infect to max_infect days above, k > 0 for a gamma distribution with the same mean, an Erlang distribution for integer k)
+incubate_shape = 0
+infect_shape = 0
+
+network = None # contact network of the n individuals for the vectorized engine (None for uniform mixing), see Contact Networks
+
 p_e=0
 tt, results = simulate1D()
 
@@ -125,34 +141,37 @@ nc1_lam = 7
 
 plot_average_over_realizations(100, parameter = '')
 
-def plot_average_over_realizations(n_realizations, parameter = 'p_e'):
+def average_over_realizations(n_realizations, seed = None, workers = None, targets = None):
     '''
-    Input: number of realizations to average over
+    averages n_realizations realizations, run in parallel by iter_realizations (seed and workers are
+    passed on to it) and aggregated one at a time by the ensemble statistics; shorter realizations
+    are padded with their last census
+    with targets, only as many of the n_realizations realizations are run as adaptive_ensemble needs to
+    meet them
+    for a given seed, the average is kept in the result cache
+    returns the timesteps and the T x 6 average
     '''
-     # Create dictionaries to store the times and results of each realization
-    tts = {}
-    results = {}
-
-    # Simulate n_realizations given the p, nc, pt values passed to the function
-    for i in range(n_realizations):
-        tts[i], results[i] = simulate1D()
-        
-    timesteps_per_realization = []
-    for n in range(n_realizations):
-        timesteps_per_realization.append(len(list(results.values())[n]))
-    
-    max_num_timesteps = max(timesteps_per_realization)
-    max_idx = np.argmax(timesteps_per_realization)
-        
-    for n in range(n_realizations):
-        if len(results[n]) < max_num_timesteps:
-            new_val = results[n] + [results[n][-1]]*(max_num_timesteps - len(results[n]))
-            results[n] = new_val
+    def compute():
+        if targets is None:
+            tt, summary = ensemble_stats(n_realizations, seed=seed, workers=workers)
+        else:
+            table, report = adaptive_ensemble(targets, n_realizations, seed=seed, workers=workers)
+            tt, summary = report['ensemble']
+        return {'average': summary['mean']}
     
-    avg_over_realizations = np.average(np.array(list(results.values())), axis = 0)
+    variant = f'average_over_realizations/{n_realizations}' + ('' if targets is None else f'/{json.dumps(targets, sort_keys=True)}')
+    avg_over_realizations = cached_call(variant, seed, compute)['average']
+    return list(range(len(avg_over_realizations))), avg_over_realizations
+
+def plot_average_over_realizations(n_realizations, parameter = 'p_e', seed = None, workers = None, targets = None):
+    '''
+    Input: number of realizations to average over (the budget if there are targets)
+    the realizations are averaged by average_over_realizations (seed, workers and targets are passed on to it)
+    '''
+    tt, avg_over_realizations = average_over_realizations(n_realizations, seed=seed, workers=workers, targets=targets)
 
     plt.figure()
-    plt.plot(tts[max_idx], avg_over_realizations)
+    plt.plot(tt, avg_over_realizations)
     
     ########## CHANGE THE TITLE HERE ##########
 #     plt.title(f'Baseline: $\lambda_1$={nc1_lam}, p_e = {p_e}, p_i = {p_i}, p_f = 2.66%')
@@ -350,7 +369,7 @@ def epidemic1D(pop1, t_e, t_i, t_u):
             # generate contacts and with probability p_e, an 's' individual will become 'e'
             for c in range(nc1):
                 k=j
-                while k==j and pop1[k]!='f': # make sure we only count contacts with a different and alive individual
+                while k==j or pop1[k]=='f': # make sure we only count contacts with a different and alive individual
                     k=np.random.randint(n)
                 
                 # see if susceptible person is exposed
@@ -366,7 +385,7 @@ def epidemic1D(pop1, t_e, t_i, t_u):
             # generate contacts and with probability p_e, an 's' individual will become 'e'
             for c in range(nc2):
                 k=j
-                while k==j and pop1[k]!='f': # make sure we only count contacts with a different and alive individual
+                while k==j or pop1[k]=='f': # make sure we only count contacts with a different and alive individual
                     k=np.random.randint(n)
                 
                 # see if susceptible person is exposed
@@ -407,18 +426,19 @@ def epidemic1D(pop1, t_e, t_i, t_u):
         
     return pop2, t_e2, t_i2, t_u2
 
-def plot_realizations(n_realizations):
+def plot_realizations(n_realizations, seed=None, workers=None):
     '''
     Produces a plot with many realizations of S, I, R populations vs time
     Inputs: n_realizations: number of realizations to plot
+            seed, workers: passed on to run_realizations
     '''
     # Create dictionaries to store the times and results of each realization
     tts = {}
     results = {}
 
     # Simulate n_realizations given the p, nc, pt values passed to the function
-    for i in range(n_realizations):
-        tts[i], results[i] = simulate1D()
+    for i, (tt, result) in enumerate(run_realizations(n_realizations, seed=seed, workers=workers)):
+        tts[i], results[i] = tt, result
     
     # Create the figure
     plt.figure(figsize=(12,9))
@@ -440,84 +460,1393 @@ def plot_realizations(n_realizations):
     plt.ylabel('Population')
     plt.legend(['S', 'E', 'I', 'U', 'R', 'F' ])
 
-"""# Sensitivity Testing"""
+"""# Vectorized Engine"""
 
-# GLOBAL VARIABLES
-n = 10000 # population
+# integer codes of the agent states, in the same order census1D reports them
+S_CODE, E_CODE, I_CODE, U_CODE, R_CODE, F_CODE = range(6)
 
-nc1_lam = 1.665 # rate of contacts per day of exposed and undetected people (modelled by Poisson)
-nc2_lam = 1 # rate of contacts per day of symptomatic infected people (modelled by Poisson)
+def simulate1D_vec(seed=None, verify=False, crn=False):
+    """
+    vectorized counterpart of simulate1D: the population is an int8 array of state codes
+    and each day is advanced by epidemic1D_vec, which draws all contacts of the day at once
+    this is a single-realization ensemble, see simulate_ensemble
+    returns the same time and results lists as simulate1D
+    """
+    tt, results = simulate_ensemble(1, seed=seed, verify=verify, crn=crn)
+    return tt, results[0].tolist()
 
-incubate_time = 2 # days that incubation lasts (before an 'e' individual becomes 'i', symptomatic, or 'u', asymptomatic)
+def simulate_ensemble(n_realizations, seed=None, verify=False, crn=False, checkpoint=None, checkpoint_every=30):
+    """
+    advances n_realizations independent realizations in lockstep: the populations are the rows of
+    an n_realizations x n int8 state matrix and each day of all of them is drawn by a single call to
+    epidemic1D_vec, so the interpreter overhead is shared by the whole ensemble
+    
+    instead of a census of the whole population after every day, the counts of each state are
+    kept up to date from the transitions of the day; with verify=True they are also checked
+    against a full recount every day
+    only the currently contagious individuals (the ones in the `calendar`) are visited, so the work
+    per day scales with the number of 'e', 'i', and 'u' individuals and not with n; a realization
+    whose epidemic has died out has no individuals left in the calendar and keeps its last census
+    
+    with crn=True the days are drawn by epidemic1D_crn, with the common random numbers of the crn_key of
+    the seed (of its children for an ensemble), see Common Random Numbers
+    
+    with a checkpoint path, the whole state of the ensemble is saved there every checkpoint_every days,
+    and if the file already exists the run resumes from it, after checking that it is a checkpoint of the
+    same run (see Checkpoints); the file is removed once the run is complete
+    
+    returns the list of timesteps and an n_realizations x T x 6 array of the censuses
+    """
+    if checkpoint is not None and os.path.exists(checkpoint):
+        state = load_checkpoint(checkpoint)
+        if len(state['counts']) != n_realizations:
+            raise ValueError(f'{checkpoint} is a checkpoint of {len(state["counts"])} realizations, not {n_realizations}')
+        if (state['keys'] is not None) != crn:
+            raise ValueError(f'{checkpoint} is a checkpoint of a run with crn={state["keys"] is not None}')
+        if seed is not None and seed_record(seed) != seed_record(state['seed']):
+            raise ValueError(f'{checkpoint} is a checkpoint of a run with seed {seed_record(state["seed"])}')
+    else:
+        state = new_ensemble_state(n_realizations, seed=seed, crn=crn)
+    advance_ensemble(state, verify=verify, checkpoint=checkpoint, checkpoint_every=checkpoint_every)
+    
+    # return time and results
+    return list(range(state['t'] + 1)), np.stack(state['results'], axis=1)
 
-# generate uniform distribution (nearest integer)
-min_infect = 5 # minimum number of days infected or undetected person (i.e. symptomatic or asymptomatic) is contagious
-max_infect = 15 # maximum number of days infected or undetected person (i.e. symptomatic or asymptomatic) is contagious
+def new_ensemble_state(n_realizations, seed=None, crn=False):
+    '''
+    state of an ensemble of n_realizations realizations on day 0 (see simulate_ensemble): the day `t`, the
+    n_realizations x n state matrix `pop`, the `calendar` and `alive` set of epidemic1D_vec, the running
+    `counts`, the list of daily censuses `results`, the `seed` (a SeedSequence) and the random number
+    generator `rng` (or the common random number `keys` with crn=True)
+    '''
+    if network is not None and len(network['indptr']) - 1 != n:
+        raise ValueError(f'the contact network has {len(network["indptr"]) - 1} individuals, but n = {n}')
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seed_seq) # random number generator of the ensemble
+    pop=np.tile(initial1D_vec(n,0,0,0,0,0), (n_realizations, 1)) # initial susceptible, exposed, infected, recovered, and undetected
+    
+    pop[:, int(n/2)-1]=I_CODE # 1 infection to start with in every realization
+    
+    # day on which the 'e', 'i', and 'u' individuals leave their state, see epidemic1D_vec
+    calendar={}
+    first=np.arange(n_realizations)*n + int(n/2)-1 # flat indices of the first infections
+    keys=None
+    if crn:
+        keys = np.array([crn_key(seed_seq)]) if n_realizations == 1 else np.array([crn_key(child) for child in seed_seq.spawn(n_realizations)])
+        u = hashed_uniform(keys, int(n/2)-1, 0, DAYS_SLOT)
+        schedule(calendar, first, infectious_days(None, n_realizations, u=u)) # add day on which the individuals stop being infected
+    else:
+        schedule(calendar, first, infectious_days(rng, n_realizations)) # add day on which the individuals stop being infected
+    alive=new_alive(n_realizations, n) # individuals that can be contacted, see epidemic1D_vec
+
+    counts=np.array([census1D_vec(row) for row in pop]) # running number of individuals in each state, per realization
+    return {'t': 0, # counts number of days, starting from the 0th day
+            'pop': pop, 'calendar': calendar, 'alive': alive, 'counts': counts,
+            'results': [counts.copy()], # add starting populations into an array
+            'seed': seed_seq, 'rng': rng, 'keys': keys}
+
+def advance_ensemble(state, until=None, verify=False, checkpoint=None, checkpoint_every=30):
+    '''
+    advances the state of an ensemble (see new_ensemble_state) in place, day by day, until no realization has
+    an exposed, infected, or undetected individual left or day `until` is reached, saving it to the checkpoint
+    path (if given) every checkpoint_every days and removing the checkpoint once the epidemics are over
+    '''
+    pop, calendar, alive, counts = state['pop'], state['calendar'], state['alive'], state['counts']
+    
+    # as long as there is an exposed, infected, or undetected individual, the infection will continue to spread
+    while counts[:, [E_CODE, I_CODE, U_CODE]].any() and (until is None or state['t'] < until):
+        t = state['t']
+        
+        # advances pop, the calendar and the alive set by one day in place
+        if state['keys'] is not None:
+            counts+=epidemic1D_crn(pop, calendar, alive, t+1, state['keys'])
+        else:
+            counts+=epidemic1D_vec(pop, calendar, alive, t+1, state['rng'])
+        
+        if verify:
+            recount = np.array([census1D_vec(row) for row in pop])
+            if not np.array_equal(counts, recount):
+                raise RuntimeError(f'running census {counts.tolist()} does not match recount {recount.tolist()} on day {t+1}')
+        state['results'].append(counts.copy()) # add current population into an array
+        
+        # update time
+        state['t'] = t+1
+        if checkpoint is not None and state['t'] % checkpoint_every == 0:
+            save_checkpoint(checkpoint, state)
+    
+    if checkpoint is not None and not counts[:, [E_CODE, I_CODE, U_CODE]].any() and os.path.exists(checkpoint):
+        os.remove(checkpoint) # the run is complete, so a later run must not resume from it
+    return state
 
-# probabilities
-p_e = 0.201    # prob of being exposed after contact 
-p_i = 0.484   # prob of becoming symptomatic / infected
-p_u = 1 - p_i # prob of becoming asymptomatic (undetected)
-p_f = 2.6605/100    # prob of a fatality (assuming only symptomatic individuals may die)
+def initial1D_vec(s0,e0,i0,u0,r0,f0):
+    '''
+    int8 version of initial1D: each state subpopulation is a block of its state code
+    '''
+    return np.repeat(np.arange(6, dtype=np.int8), [s0, e0, i0, u0, r0, f0])
 
-pd.set_option("display.max_rows", None, "display.max_columns", None)
+def census1D_vec(pop):
+    # counts the number of s, e, i, u, r, and f cells of an int8 pop in a single pass
+    return tuple(np.bincount(pop, minlength=6).tolist())
 
-# change title before running function
-for prob in [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]:
-    p_e = prob
-    print(p_e)
-    display(plot_average_over_realizations(100, parameter = 'p_e'))
+def epidemic1D_vec(pop, calendar, alive, day, rng):
+    '''
+    vectorized version of epidemic1D with the same model semantics: every contagious ('e', 'i', 'u')
+    individual draws a poisson number of contacts (nc1_lam for 'e' and 'u', nc2_lam for 'i'), each contact
+    is a different alive individual chosen uniformly at random, and an 's' contact becomes 'e' with
+    probability p_e. Instead of looping over the population, all contacts of the day are drawn in a few
+    batched calls: one poisson draw for the contagious individuals, one draw of contact targets and one
+    draw of exposure thresholds.
+    
+    `alive` explained:
+    Contact targets are drawn from the alive set of new_alive, which keeps the indices of the individuals
+    that are not 'f' packed at the start of an array, so a target is a single uniform draw of a position
+    instead of a rejection loop. Fatalities are removed from it at the end of the day by remove_alive.
+    
+    `calendar` explained:
+    Instead of the `t_e`, `t_i`, and `t_u` countdowns, the day on which an individual leaves the 'e', 'i',
+    or 'u' state is drawn once, when it enters the state, and the individual is filed in the calendar under
+    that day (a dictionary of day -> list of index arrays, see schedule). Advancing to `day` pops only the
+    bucket of that day, so no timer is touched on the days in between and the work on the timers scales
+    with the number of transitions. Every individual in the calendar is contagious, so the calendar also
+    holds the individuals that make contacts: the population is never scanned. `pop` and `calendar` are
+    updated in place.
+    
+    The durations are drawn by incubation_days and infectious_days, so other distributions of the
+    durations only change these draws.
+    
+    `pop` is either a single population of n individuals or an ensemble of populations stored as the rows
+    of a matrix. In the latter case the calendar holds flat indices into the matrix, and contacts stay within
+    the row (realization) of the contagious individual.
+    
+    returns the change in the number of s, e, i, u, r, and f individuals over the day (one row per
+    realization for an ensemble)
+    '''
+    n=pop.shape[-1] # population of each realization
+    shape, n_realizations = pop.shape[:-1], pop.size // n
+    pop = pop.reshape(-1) # flat view of the ensemble
+    
+    # contagious individuals and their number of contacts
+    active = np.concatenate([idx for bucket in calendar.values() for idx in bucket] or [np.empty(0, dtype=np.int64)])
+    state = pop[active]
+    lam = np.where(state==I_CODE, nc2_lam, nc1_lam) # 'i' individuals change behavior
+    contacts = np.repeat(active, rng.poisson(lam))
+    
+    # each contact is drawn among the other alive individuals of the same realization, or among the
+    # neighbours of the contagious individual in the contact network
+    targets = sample_alive(alive, contacts, rng) if network is None else sample_neighbours(network, contacts, rng)
+    
+    # see which susceptible contacts are exposed (applied after the transitions, which only concern
+    # individuals who were already 'e', 'i', or 'u' at the start of the day)
+    exposed = np.unique(targets[(pop[targets]==S_CODE) & (rng.random(targets.size) < p_e)])
+    
+    # individuals whose 'e', 'i', or 'u' state ends today
+    done = np.concatenate(calendar.pop(day, [np.empty(0, dtype=np.int64)]))
+    state = pop[done]
+    
+    # exposed individuals at the end of their incubation become symptomatic or asymptomatic
+    done_e = done[state==E_CODE]
+    symptomatic = rng.random(done_e.size) < p_i
+    pop[done_e] = np.where(symptomatic, I_CODE, U_CODE)
+    schedule(calendar, done_e, day + infectious_days(rng, done_e.size))
+    
+    # infected individuals at the end of their countdown die or recover
+    done_i = done[state==I_CODE]
+    fatality = rng.random(done_i.size) < p_f
+    pop[done_i] = np.where(fatality, F_CODE, R_CODE)
+    remove_alive(alive, done_i[fatality])
+    
+    # undetected individuals at the end of their countdown recover
+    done_u = done[state==U_CODE]
+    pop[done_u] = R_CODE
+    
+    pop[exposed] = E_CODE
+    schedule(calendar, exposed, day + incubation_days(rng, exposed.size))
+    
+    return day_delta(n, n_realizations, exposed, done_e, symptomatic, done_i, fatality, done_u).reshape(shape + (6,))
 
-# GLOBAL VARIABLES
-n = 10000 # population
+def day_delta(n, n_realizations, exposed, done_e, symptomatic, done_i, fatality, done_u):
+    '''
+    change in the number of s, e, i, u, r, and f individuals over a day, per realization (n_realizations x 6),
+    from the flat indices of the newly exposed individuals and of the 'e', 'i', and 'u' individuals whose
+    state ended, with the outcomes of the latter
+    '''
+    count = lambda idx: np.bincount(idx // n, minlength=n_realizations)
+    n_exp, n_e, n_i, n_u = count(exposed), count(done_e), count(done_i), count(done_u)
+    n_sym, n_fat = count(done_e[symptomatic]), count(done_i[fatality])
+    return np.stack([-n_exp,
+                     n_exp - n_e,
+                     n_sym - n_i,
+                     n_e - n_sym - n_u,
+                     n_i - n_fat + n_u,
+                     n_fat], axis=-1)
+
+def schedule(calendar, idx, days):
+    '''
+    files the individuals idx in the calendar under the day on which each of them leaves its state
+    (a bucket of the calendar is a list of index arrays, one per call that added to it)
+    '''
+    order = np.argsort(days, kind='stable')
+    idx, days = idx[order], days[order]
+    bounds = np.flatnonzero(np.diff(days)) + 1 # start of each run of equal days
+    for day, part in zip(days[np.r_[0, bounds]] if days.size else [], np.split(idx, bounds)):
+        calendar.setdefault(int(day), []).append(part)
 
-nc1_lam = 1.665 # rate of contacts per day of exposed and undetected people (modelled by Poisson)
-nc2_lam = 1 # rate of contacts per day of symptomatic infected people (modelled by Poisson)
+def new_alive(n_realizations, n):
+    '''
+    alive set of an ensemble of n_realizations populations of n individuals (all alive at first): the flat
+    indices of the alive individuals of every realization are packed in the first `count` entries of its row
+    of `index`, and `position` holds the column of every individual in that row
+    '''
+    return {'index': np.arange(n_realizations*n).reshape(n_realizations, n),
+            'position': np.tile(np.arange(n), n_realizations),
+            'count': np.full(n_realizations, n)}
 
-incubate_time = 2 # days that incubation lasts (before an 'e' individual becomes 'i', symptomatic, or 'u', asymptomatic)
+def sample_alive(alive, contacts, rng):
+    '''
+    draws a target for every contact of the flat indices `contacts` (alive individuals), uniformly among the
+    other alive individuals of the same realization, in one call: a position below count-1 is drawn and
+    positions from the contagious individual's own onwards are shifted up by one to skip over it
+    contacts of an individual who is the last one alive in its realization are dropped
+    '''
+    index, position, count = alive['index'], alive['position'], alive['count']
+    row = contacts // index.shape[1]
+    others = count[row] - 1
+    if not others.all():
+        contacts, row, others = contacts[others > 0], row[others > 0], others[others > 0]
+    targets = rng.integers(others)
+    targets += targets >= position[contacts]
+    return index[row, targets]
+
+def remove_alive(alive, idx):
+    '''
+    removes the individuals idx (flat indices) from the alive set: the last alive individual of the realization
+    is moved into the position of each removed one, so the cost is proportional to the number of fatalities
+    '''
+    index, position, count = alive['index'], alive['position'], alive['count']
+    for j in idx.tolist():
+        row = j // index.shape[1]
+        count[row] -= 1
+        last = index[row, count[row]]
+        index[row, position[j]] = last
+        position[last] = position[j]
+
+def incubation_days(rng, size, u=None):
+    '''
+    number of days that each of `size` newly exposed individuals stays 'e': incubate_time, or a gamma
+    distribution with shape incubate_shape and mean incubate_time rounded to whole days (at least 1)
+    the random durations are drawn from rng, or from the uniform random numbers u by inversion
+    '''
+    if incubate_shape > 0:
+        scale = incubate_time/incubate_shape
+        days = rng.gamma(incubate_shape, scale, size) if u is None else gammaincinv(incubate_shape, u) * scale
+        return np.maximum(np.rint(days), 1).astype(np.int64)
+    return np.full(size, max(incubate_time, 1), dtype=np.int64)
 
-# generate uniform distribution (nearest integer)
-min_infect = 5 # minimum number of days infected or undetected person (i.e. symptomatic or asymptomatic) is contagious
-max_infect = 15 # maximum number of days infected or undetected person (i.e. symptomatic or asymptomatic) is contagious
+def infectious_days(rng, size, u=None):
+    '''
+    number of days that each of `size` individuals stays 'i' or 'u': a uniform draw between min_infect and
+    max_infect truncated to an integer as in epidemic1D, or a gamma distribution with shape infect_shape and
+    the same mean rounded to whole days (at least 1, a countdown of 0 days also ends on the next day)
+    the durations are drawn from rng, or from the uniform random numbers u by inversion
+    '''
+    if infect_shape > 0:
+        scale = (min_infect + max_infect) / 2 / infect_shape
+        days = rng.gamma(infect_shape, scale, size) if u is None else gammaincinv(infect_shape, u) * scale
+        return np.maximum(np.rint(days), 1).astype(np.int64)
+    days = rng.uniform(min_infect, max_infect, size=size) if u is None else min_infect + (max_infect - min_infect)*u
+    return np.maximum(days.astype(np.int64), 1)
+
+"""## Common Random Numbers
+
+Realizations drawn from a np.random.Generator use its numbers in the order they are needed, so changing a parameter
+such as `p_e` shifts every later draw and two runs with the same seed soon have nothing in common. With common random
+numbers (`crn=True`), every random number is instead a hash of the realization's key, the individual, the day and
+the purpose of the number (`hashed_uniform`, a splitmix64 hash that needs no state). An individual draws the same
+number of contacts, the same targets, the same exposure thresholds and the same durations on the same day whatever the
+parameters, so runs at nearby parameter values with the same seeds differ only where a threshold comparison flips,
+and the difference between them has far less Monte-Carlo noise than the difference between independent runs.
+"""
 
-# probabilities
-p_e = 0.201    # prob of being exposed after contact 
-p_i = 0.484   # prob of becoming symptomatic / infected
-p_u = 1 - p_i # prob of becoming asymptomatic (undetected)
-p_f = 2.6605/100    # prob of a fatality (assuming only symptomatic individuals may die)
+# purposes of the hashed random numbers of an individual on a day; contact c uses CONTACT_SLOT + 3*c, +1 and +2
+COUNT_SLOT, OUTCOME_SLOT, DAYS_SLOT, CONTACT_SLOT = range(4)
 
-pd.set_option("display.max_rows", None, "display.max_columns", None)
+def crn_key(seed=None):
+    # 64-bit key of the hashed random numbers of a realization, from its seed (an int or a np.random.SeedSequence)
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return seed_seq.generate_state(1, dtype=np.uint64)[0]
 
-# change title before running function
-for prob in [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]:
-    p_i = prob
-    print(p_i)
-    display(plot_average_over_realizations(100, parameter = 'p_i'))
+def splitmix64(x):
+    # splitmix64 finalizer: a bijective mix of the bits of uint64 x (overflow wraps around)
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
 
-# GLOBAL VARIABLES
-n = 10000 # population
+def hashed_uniform(key, individual, day, slot):
+    '''
+    uniform random numbers in [0, 1) that only depend on the realization key, the individual (index within its
+    population), the day and the slot (purpose of the number); the inputs are broadcast against each other
+    '''
+    h = splitmix64(np.asarray(key, dtype=np.uint64) + np.asarray(individual, dtype=np.uint64))
+    h = splitmix64(h + np.asarray(day, dtype=np.uint64))
+    h = splitmix64(h + np.asarray(slot, dtype=np.uint64))
+    return (h >> np.uint64(11)) * 2.0**-53
+
+def poisson_quantile(lam, u):
+    # poisson random numbers with means lam from uniform random numbers u, by inverting the cumulative distribution
+    values, which = np.unique(lam, return_inverse=True)
+    counts = np.empty(len(u), dtype=np.int64)
+    for k, mean in enumerate(values):
+        x = np.arange(int(mean + 20*np.sqrt(mean) + 20))
+        cdf = np.cumsum(np.exp(x*np.log(mean) - mean - gammaln(x + 1))) if mean > 0 else np.ones(1)
+        counts[which == k] = np.searchsorted(cdf, u[which == k], side='right')
+    return counts
+
+def epidemic1D_crn(pop, calendar, alive, day, keys):
+    '''
+    epidemic1D_vec with common random numbers: the same model, with every random number drawn by hashed_uniform
+    from the key of the realization (`keys` has one key per row of an ensemble), the individual and the day
+    
+    A contact target is drawn among the other n-1 individuals, so that it does not depend on who has died;
+    a target that has died is replaced by a draw from the alive set, which makes the targets uniform among
+    the other alive individuals like those of epidemic1D_vec.
+    '''
+    n=pop.shape[-1] # population of each realization
+    shape, n_realizations = pop.shape[:-1], pop.size // n
+    pop = pop.reshape(-1) # flat view of the ensemble
+    keys = np.reshape(keys, -1)
+    draw = lambda idx, slot: hashed_uniform(keys[idx // n], idx % n, day, slot)
+    
+    # contagious individuals and their number of contacts
+    active = np.concatenate([idx for bucket in calendar.values() for idx in bucket] or [np.empty(0, dtype=np.int64)])
+    state = pop[active]
+    lam = np.where(state==I_CODE, nc2_lam, nc1_lam) # 'i' individuals change behavior
+    n_contacts = poisson_quantile(lam, draw(active, COUNT_SLOT))
+    contacts = np.repeat(active, n_contacts)
+    slot = CONTACT_SLOT + 3*(np.arange(contacts.size) - np.repeat(np.cumsum(n_contacts) - n_contacts, n_contacts))
+    
+    if network is None:
+        # each contact is drawn among the other n-1 individuals of the same realization (skipping over
+        # the contagious individual itself)
+        first = contacts - contacts % n # index of the first individual of the realization
+        targets = (draw(contacts, slot) * (n-1)).astype(np.int64)
+        targets += targets >= contacts - first
+        targets += first
+        
+        # targets who have died are replaced by one of the other alive individuals
+        dead = np.flatnonzero(pop[targets]==F_CODE)
+        if dead.size:
+            index, position, count = alive['index'], alive['position'], alive['count']
+            row = contacts[dead] // n
+            replacement = (draw(contacts[dead], slot[dead] + 1) * (count[row] - 1)).astype(np.int64)
+            replacement += replacement >= position[contacts[dead]]
+            targets[dead] = index[row, np.minimum(replacement, count[row] - 1)]
+            lost = dead[count[row] < 2] # the last individual alive has no one to contact
+            targets[lost] = contacts[lost]
+    else:
+        # each contact is drawn among the neighbours of the contagious individual in the contact network
+        node = contacts % n
+        start, degree = network['indptr'][node], network['indptr'][node+1] - network['indptr'][node]
+        targets = contacts.copy() # individuals without neighbours make no contacts (they contact themselves)
+        has = degree > 0
+        offset = (draw(contacts[has], slot[has]) * degree[has]).astype(np.int64)
+        targets[has] = contacts[has] - node[has] + network['indices'][start[has] + offset]
+    
+    # see which susceptible contacts are exposed
+    exposed = np.unique(targets[(pop[targets]==S_CODE) & (draw(contacts, slot + 2) < p_e)])
+    
+    # individuals whose 'e', 'i', or 'u' state ends today
+    done = np.concatenate(calendar.pop(day, [np.empty(0, dtype=np.int64)]))
+    state = pop[done]
+    
+    # exposed individuals at the end of their incubation become symptomatic or asymptomatic
+    done_e = done[state==E_CODE]
+    symptomatic = draw(done_e, OUTCOME_SLOT) < p_i
+    pop[done_e] = np.where(symptomatic, I_CODE, U_CODE)
+    schedule(calendar, done_e, day + infectious_days(None, done_e.size, u=draw(done_e, DAYS_SLOT)))
+    
+    # infected individuals at the end of their countdown die or recover
+    done_i = done[state==I_CODE]
+    fatality = draw(done_i, OUTCOME_SLOT) < p_f
+    pop[done_i] = np.where(fatality, F_CODE, R_CODE)
+    remove_alive(alive, done_i[fatality])
+    
+    # undetected individuals at the end of their countdown recover
+    done_u = done[state==U_CODE]
+    pop[done_u] = R_CODE
+    
+    pop[exposed] = E_CODE
+    schedule(calendar, exposed, day + incubation_days(None, exposed.size, u=draw(exposed, DAYS_SLOT)))
+    
+    return day_delta(n, n_realizations, exposed, done_e, symptomatic, done_i, fatality, done_u).reshape(shape + (6,))
 
-nc1_lam = 1.665 # rate of contacts per day of exposed and undetected people (modelled by Poisson)
-nc2_lam = 1 # rate of contacts per day of symptomatic infected people (modelled by Poisson)
+"""## Contact Networks
 
-incubate_time = 2 # days that incubation lasts (before an 'e' individual becomes 'i', symptomatic, or 'u', asymptomatic)
+By default the vectorized engine assumes uniform mixing: any individual can contact any other. When the global
+variable `network` is set to a contact network of the n individuals, every contact of a contagious individual is
+instead drawn uniformly among its neighbours in the network (contacts with neighbours who have died are lost).
 
-# generate uniform distribution (nearest integer)
-min_infect = 5 # minimum number of days infected or undetected person (i.e. symptomatic or asymptomatic) is contagious
-max_infect = 15 # maximum number of days infected or undetected person (i.e. symptomatic or asymptomatic) is contagious
+A network is stored in compressed sparse row (CSR) form: the neighbours of individual j are
+`indices[indptr[j]:indptr[j+1]]`. With int32 `indices`, a network of 10M individuals with 10 contacts each takes about
+480 MB, and the neighbours of all contagious individuals are drawn in one call. Networks are loaded from (and saved to)
+`.npz` files with `indptr` and `indices` arrays, which is also the format of `scipy.sparse.save_npz`, or built with
+the functions below and combined into layers, e.g. households, schools and workplaces.
+"""
 
-# probabilities
-p_e = 0.201    # prob of being exposed after contact 
-p_i = 0.484   # prob of becoming symptomatic / infected
-p_u = 1 - p_i # prob of becoming asymptomatic (undetected)
-p_f = 2.6605/100    # prob of a fatality (assuming only symptomatic individuals may die)
+def csr_network(indptr, indices):
+    '''
+    contact network from its CSR arrays, with a fingerprint `key` of its contents so that cached results
+    of different networks are kept apart
+    '''
+    indptr, indices = np.ascontiguousarray(indptr, dtype=np.int64), np.ascontiguousarray(indices, dtype=np.int32)
+    key = hashlib.sha256()
+    key.update(indptr)
+    key.update(indices)
+    return {'indptr': indptr, 'indices': indices, 'key': key.hexdigest()}
+
+def load_network(path):
+    # reads a contact network from the indptr and indices arrays of a .npz file
+    with np.load(path) as data:
+        return csr_network(data['indptr'], data['indices'])
+
+def save_network(path, network):
+    # writes a contact network to an uncompressed .npz file
+    np.savez(path, indptr=network['indptr'], indices=network['indices'])
+
+def sample_neighbours(network, contacts, rng):
+    '''
+    draws a target for every contact of the flat indices `contacts`, uniformly among the neighbours of the
+    contagious individual in the network (contacts of individuals without neighbours are dropped); for an
+    ensemble, the targets stay within the realization of the contagious individual
+    '''
+    indptr, indices = network['indptr'], network['indices']
+    n = len(indptr) - 1
+    node = contacts % n
+    start, degree = indptr[node], indptr[node+1] - indptr[node]
+    if not degree.all():
+        contacts, node, start, degree = contacts[degree > 0], node[degree > 0], start[degree > 0], degree[degree > 0]
+    return contacts - node + indices[start + rng.integers(degree)]
+
+def edges_to_csr(u, v, n):
+    '''
+    undirected contact network of n individuals from the edges (u[k], v[k]); self-contacts and
+    repeated edges are dropped
+    '''
+    u, v = np.asarray(u, dtype=np.int64), np.asarray(v, dtype=np.int64)
+    pairs = np.concatenate([u*n + v, v*n + u]) # both directions of every edge, as source*n + target
+    pairs.sort() # sorted by source, then by target (in place, these arrays are the largest ones)
+    keep = np.empty(len(pairs), dtype=bool)
+    keep[:1] = True
+    np.not_equal(pairs[1:], pairs[:-1], out=keep[1:])
+    keep &= pairs // n != pairs % n
+    pairs = pairs[keep]
+    indptr = np.searchsorted(pairs, np.arange(n+1, dtype=np.int64)*n)
+    pairs %= n
+    return csr_network(indptr, pairs)
+
+def network_edges(network):
+    # edges (u, v) of a contact network, each undirected edge appearing in both directions
+    indptr = network['indptr']
+    return np.repeat(np.arange(len(indptr)-1), np.diff(indptr)), network['indices']
+
+def combine_networks(*networks):
+    # union of the layers of contacts of the same n individuals, e.g. households, schools and workplaces
+    edges = [network_edges(network) for network in networks]
+    return edges_to_csr(np.concatenate([u for u, v in edges]), np.concatenate([v for u, v in edges]),
+                        len(networks[0]['indptr']) - 1)
+
+def erdos_renyi_network(n, mean_degree, seed=None):
+    # random network in which every pair of individuals is in contact with probability mean_degree/(n-1)
+    rng = np.random.default_rng(seed)
+    m = rng.poisson(n*mean_degree/2) # number of edges
+    return edges_to_csr(rng.integers(n, size=m), rng.integers(n, size=m), n)
+
+def scale_free_network(n, exponent=2.5, min_degree=2, seed=None):
+    '''
+    configuration-model network with a power-law degree distribution P(k) ~ k^-exponent for k >= min_degree:
+    the stubs of all individuals are shuffled and paired (self-contacts and repeated edges are dropped)
+    '''
+    rng = np.random.default_rng(seed)
+    degree = np.minimum(min_degree * (1 - rng.random(n)) ** (-1/(exponent-1)), n-1).astype(np.int64)
+    stubs = rng.permutation(np.repeat(np.arange(n), degree))
+    m = len(stubs) // 2
+    return edges_to_csr(stubs[:m], stubs[m:2*m], n)
 
-pd.set_option("display.max_rows", None, "display.max_columns", None)
+def random_groups(n, mean_size, fraction=1, seed=None):
+    '''
+    assigns a random fraction of n individuals to groups (e.g. households, classes or workplaces) of
+    1 + poisson(mean_size-1) members; returns the group of every individual (-1 for none)
+    '''
+    rng = np.random.default_rng(seed)
+    members = rng.permutation(n)[:int(round(fraction*n))]
+    sizes = 1 + rng.poisson(mean_size - 1, size=len(members)) # more groups than can be filled
+    groups = np.full(n, -1, dtype=np.int64)
+    groups[members] = np.repeat(np.arange(len(sizes)), sizes)[:len(members)]
+    return groups
+
+def clique_network(groups):
+    # network in which all members of a group are in contact with each other (e.g. households)
+    members = np.flatnonzero(groups >= 0)
+    members = members[np.argsort(groups[members], kind='stable')]
+    group = groups[members]
+    u, v = [], []
+    for d in range(1, np.bincount(group).max() if len(group) else 1):
+        same = group[:-d] == group[d:] # members d places apart in the same group
+        u.append(members[:-d][same])
+        v.append(members[d:][same])
+    return edges_to_csr(np.concatenate(u or [members[:0]]), np.concatenate(v or [members[:0]]), len(groups))
+
+def group_network(groups, mean_degree, seed=None):
+    '''
+    network of random contacts within groups that are too large to be cliques (e.g. schools or
+    workplaces): members have mean_degree contacts on average, all with members of their own group
+    '''
+    rng = np.random.default_rng(seed)
+    members = np.flatnonzero(groups >= 0)
+    members = members[np.argsort(groups[members], kind='stable')]
+    _, start, size = np.unique(groups[members], return_index=True, return_counts=True)
+    rank = np.repeat(np.arange(len(start)), size) # group of every member, in order
+    m = rng.poisson(len(members)*mean_degree/2) # number of edges
+    u = rng.integers(len(members), size=m)
+    v = start[rank[u]] + rng.integers(size[rank[u]])
+    return edges_to_csr(members[u], members[v], len(groups))
+
+def household_network(n, mean_size=2.5, seed=None):
+    # network of n individuals living in households of 1 + poisson(mean_size-1) members
+    return clique_network(random_groups(n, mean_size, seed=seed))
+
+"""## Chain-Binomial Engine
+
+Apart from their countdowns, individuals in the agent model have no identity: with uniform mixing, only the number of
+individuals in each (state, days left) bucket matters. `simulate1D_counts` advances these bucket counts with binomial and
+multinomial draws that follow the daily rules of `epidemic1D`, so its cost per day does not depend on `n`.
+
+Each contagious individual makes a poisson number of contacts with the other n-F-1 alive individuals, so every
+susceptible individual receives a poisson number of successful (probability `p_e`) contacts with mean
+p_e * (nc1_lam * (E + U) + nc2_lam * I) / (n - F - 1), independently of the others. The number of newly exposed individuals is
+therefore binomial with the probability that this number is not 0.
+"""
+
+def simulate1D_counts(seed=None):
+    """
+    count-based counterpart of simulate1D: the population is kept as the number of 's', 'r', and 'f'
+    individuals and the number of 'e', 'i', and 'u' individuals with each number of days left
+    (uniform mixing with the durations of epidemic1D: network, incubate_shape and infect_shape are not used)
+    returns the same time and results lists as simulate1D
+    """
+    rng = np.random.default_rng(seed) # random number generator of this realization
+    t=0 # counts number of days, starting from the 0th day
+    
+    # probabilities of the number of days in the 'i' or 'u' state, int(uniform(min_infect, max_infect)),
+    # where a countdown of 0 days ends on the next day just like one of 1 day
+    days = np.arange(int(np.ceil(max_infect)) + 1)
+    p_days = np.clip(np.minimum(days + 1, max_infect) - np.maximum(days, min_infect), 0, None) / (max_infect - min_infect)
+    p_days[1] += p_days[0]
+    p_days[0] = 0
+    
+    # number of 'e', 'i', and 'u' individuals by days left (index 0 is unused)
+    e_left = np.zeros(max(incubate_time, 1) + 1, dtype=np.int64)
+    i_left = np.zeros(len(days), dtype=np.int64)
+    u_left = np.zeros(len(days), dtype=np.int64)
+    
+    s, r, f = n - 1, 0, 0
+    i_left[rng.choice(len(days), p=p_days)] = 1 # 1 infection to start with
+    
+    results=[[s, 0, 1, 0, r, f]] # add starting populations into an array
+    tt=[t] # keep track of the timesteps
+    
+    # as long as there is an exposed, infected, or undetected individual, the infection will continue to spread
+    while e_left.any() or i_left.any() or u_left.any():
+        e, i, u = e_left.sum(), i_left.sum(), u_left.sum()
+        
+        # exposures, from the contacts of the contagious individuals at the start of the day
+        contacts = p_e * (nc1_lam*(e + u) + nc2_lam*i) / max(n - f - 1, 1)
+        exposed = rng.binomial(s, -np.expm1(-contacts))
+        
+        # update time left in 'e', 'i', and 'u' states
+        done_e, done_i, done_u = e_left[1], i_left[1], u_left[1]
+        e_left[1:-1], i_left[1:-1], u_left[1:-1] = e_left[2:], i_left[2:], u_left[2:]
+        e_left[-1] = i_left[-1] = u_left[-1] = 0
+        
+        # exposed individuals at the end of their incubation become symptomatic or asymptomatic
+        symptomatic = rng.binomial(done_e, p_i)
+        i_left += rng.multinomial(symptomatic, p_days)
+        u_left += rng.multinomial(done_e - symptomatic, p_days)
+        
+        # infected individuals at the end of their countdown die or recover, undetected ones recover
+        fatalities = rng.binomial(done_i, p_f)
+        f += fatalities
+        r += done_i - fatalities + done_u
+        
+        s -= exposed
+        e_left[max(incubate_time, 1)] += exposed
+        
+        results.append([int(s), int(e_left.sum()), int(i_left.sum()), int(u_left.sum()), int(r), int(f)]) # add current population into an array
+        
+        # update time
+        t=t+1
+        tt.append(t)
+        
+    # return time and results
+    return tt,results
+
+"""## Hybrid Engine
+
+Chance only matters while few individuals are contagious: at the start of an epidemic, which may fade out, and in its
+tail. `simulate1D_hybrid` runs the vectorized engine while E + I + U is below `threshold` and hands the counts over to
+the `seiurf` equations of the deterministic model for the bulk of the epidemic, where the agent model would draw
+millions of contacts a day. Once E + I + U falls below `hysteresis * threshold` (lower, so that the engines do not
+alternate every day around the threshold) the rounded counts are handed back to individuals. Both hand-offs conserve
+the population exactly.
 
-# change title before running function
-for prob in [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]:
-    p_f = prob/5
-    display(plot_average_over_realizations(100, parameter = 'p_f'))
+`seiurf` and `agent_rates` are copies of the ones in deterministic_model.py, because one notebook cannot import the
+other; change them there and copy them here.
+"""
+
+def seiurf(t, y, b1, b2, d1, d2, g1, g2, d):
+    '''
+    Inputs: t is time; y is an array of arrays containing the seiurf information;
+            b1, b2 are parameters describing the average number of contacts per day for symptomatic vs asymptomatic;
+            g1, g2 are parameters describing the recovery rate for infected and undetected populations
+            d1, d2 are the rate of exposed going to infected vs undetected
+            d is the fatality rate
+    
+    '''
+    s, e, i, u, r, f = y
+    n = np.sum(y)
+
+    return np.array([-b1*s*i/n - b2*s*(u+e)/n,
+                     b1*s*i/n + b2*s*(u+e)/n - e*d1 - e*d2,
+                     e*d1 - i*g1 - i*d,
+                     e*d2 - u*g2,
+                     i*g1 + u*g2,
+                     i*d])
+
+def agent_rates(nc1_lam, nc2_lam, incubate_time, min_infect, max_infect, p_e, p_i, p_f, **other_params):
+    '''
+    rates (b1, b2, d1, d2, g1, g2, d) of seiurf that match the parameters of the agent model on average:
+    b1 is the exposure rate of symptomatic ('i') individuals, who make nc2_lam contacts per day, and b2 the one
+    of exposed and undetected individuals, who make nc1_lam contacts per day; the other rates are the inverses
+    of the mean durations (the agent model incubates for at least one day)
+    the other parameters of the agent model (e.g. n, from get_params in its notebook) do not change the rates
+    '''
+    avg_incubate = max(incubate_time, 1)
+    avg_recover = (max_infect + min_infect)/2
+    return np.array([nc2_lam * p_e,
+                     nc1_lam * p_e,
+                     p_i / avg_incubate,
+                     (1 - p_i) / avg_incubate,
+                     (1 - p_f) / avg_recover,
+                     1 / avg_recover,
+                     p_f / avg_recover])
+
+def round_counts(y, total):
+    # rounds the counts y to integers that add up to total (largest remainder method)
+    counts = np.floor(y).astype(np.int64)
+    counts[np.argsort(counts - y)[:total - counts.sum()]] += 1
+    return counts
+
+def residual_days(draw_days, rng, size):
+    '''
+    days left of `size` individuals met at a random time during a state whose duration is drawn by draw_days
+    (incubation_days or infectious_days): long stays are more likely to be met, so the days left are drawn in
+    proportion to the probability that the duration is at least that long
+    '''
+    at_least = np.cumsum(np.bincount(draw_days(rng, 4096))[::-1])[::-1][1:] # durations >= 1, 2, ...
+    return 1 + rng.choice(len(at_least), size=size, p=at_least/at_least.sum())
+
+def individuals_from_counts(counts, rng):
+    '''
+    population of individuals with the given numbers of s, e, i, u, r, and f, with the calendar of the days
+    left of the 'e', 'i', and 'u' individuals and the alive set (see epidemic1D_vec); the individuals are
+    interchangeable under uniform mixing, so their states are placed at random
+    '''
+    pop = rng.permutation(np.repeat(np.arange(6, dtype=np.int8), counts))
+    calendar = {}
+    for code, draw_days in [(E_CODE, incubation_days), (I_CODE, infectious_days), (U_CODE, infectious_days)]:
+        idx = np.flatnonzero(pop == code)
+        schedule(calendar, idx, residual_days(draw_days, rng, idx.size))
+    order = np.argsort(pop == F_CODE, kind='stable') # alive individuals first
+    position = np.empty(len(pop), dtype=np.int64)
+    position[order] = np.arange(len(pop))
+    alive = {'index': order[None], 'position': position, 'count': np.array([len(pop) - counts[F_CODE]])}
+    return pop, calendar, alive
+
+def simulate1D_hybrid(seed=None, threshold=1000, hysteresis=0.5, rates=None):
+    """
+    hybrid of simulate1D_vec and the deterministic model: individuals are simulated while fewer than threshold
+    of them are 'e', 'i', or 'u', and the counts follow seiurf from then until fewer than hysteresis * threshold
+    of them are
+    the rates (b1, b2, d1, d2, g1, g2, d) of seiurf default to agent_rates(**get_params()); seiurf has exponentially
+    distributed durations, so rates calibrated to the agent model (calibrate in deterministic_model.py) follow its
+    peak better
+    returns the same time and results lists as simulate1D
+    """
+    if network is not None:
+        raise ValueError('the hybrid engine assumes uniform mixing, set network = None')
+    rates = tuple(agent_rates(**get_params()) if rates is None else rates)
+    rng = np.random.default_rng(seed) # random number generator of this realization
+    t=0 # counts number of days, starting from the 0th day
+    
+    pop=initial1D_vec(n,0,0,0,0,0) # individuals, while they are simulated
+    pop[int(n/2)-1]=I_CODE # 1 infection to start with
+    calendar={}
+    schedule(calendar, np.array([int(n/2)-1]), infectious_days(rng, 1)) # add day on which the individual stops being infected
+    alive=new_alive(1, n)
+    start=0 # day from which the calendar counts days
+    
+    counts=np.array(census1D_vec(pop)) # number of individuals in each state
+    y=None # counts of the deterministic model, while it is solved
+    results=[counts.tolist()] # add starting populations into an array
+    tt=[t] # keep track of the timesteps
+    
+    # as long as there is an exposed, infected, or undetected individual, the infection will continue to spread
+    while counts[[E_CODE, I_CODE, U_CODE]].any():
+        contagious = counts[[E_CODE, I_CODE, U_CODE]].sum()
+        if y is None and contagious >= threshold:
+            y, pop = counts.astype(float), None # hand the counts over to the deterministic model
+        elif y is not None and contagious < hysteresis*threshold:
+            y = None # and back to individuals
+        
+        if y is None:
+            if pop is None:
+                pop, calendar, alive = individuals_from_counts(counts, rng)
+                start = t # the calendar counts days from the hand-off
+            counts = counts + epidemic1D_vec(pop, calendar, alive, t+1 - start, rng)
+        else:
+            y = solve_ivp(seiurf, [t, t+1], y, args=rates, method='RK45').y[:, -1]
+            counts = round_counts(y, n)
+        
+        results.append(counts.tolist()) # add current population into an array
+        
+        # update time
+        t=t+1
+        tt.append(t)
+        
+    # return time and results
+    return tt,results
+
+"""## Checkpoints
+
+The whole state of an ensemble (see `new_ensemble_state`) can be saved to a compressed `.npz` file and loaded back, so
+that a long run survives a crash or a preempted machine: `simulate_ensemble(..., checkpoint=path)` saves it every
+`checkpoint_every` days, resumes from the file if it exists and removes it once the run is complete. The checkpoint
+holds the state matrix, the calendar (in its order, so the contacts are drawn in the same order), the alive set, the
+censuses so far, the seed and state of the random number generator, the global variables that define the model and the
+key of the contact network, so a resumed run is bit-identical to an uninterrupted one. A checkpoint of a run with other
+global variables, another network, seed, `crn` or number of realizations is not resumed from, but raises a ValueError
+(a run with seed=None resumes with the seed of the checkpoint).
+"""
+
+def save_checkpoint(path, state):
+    # saves the state of an ensemble to path, replacing the previous checkpoint only once the new one is complete
+    calendar = state['calendar']
+    parts = [np.concatenate(bucket) for bucket in calendar.values()]
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        np.savez_compressed(file,
+                            t=state['t'],
+                            pop=state['pop'],
+                            calendar_days=np.array(list(calendar), dtype=np.int64),
+                            calendar_sizes=np.array([len(part) for part in parts], dtype=np.int64),
+                            calendar_index=np.concatenate(parts or [np.empty(0, dtype=np.int64)]),
+                            alive_index=state['alive']['index'],
+                            alive_position=state['alive']['position'],
+                            alive_count=state['alive']['count'],
+                            counts=state['counts'],
+                            results=np.stack(state['results']),
+                            seed=json.dumps(seed_record(state['seed'])),
+                            rng=json.dumps(state['rng'].bit_generator.state),
+                            keys=state['keys'] if state['keys'] is not None else np.empty(0, dtype=np.uint64),
+                            crn=state['keys'] is not None,
+                            params=json.dumps(params_record()),
+                            network='' if network is None else network['key'])
+    os.replace(tmp, path)
+
+def params_record():
+    # values of the global variables that define the model, as they are stored in a checkpoint
+    return json.loads(json.dumps(get_params(), default=lambda value: value.item()))
+
+def seed_record(seed):
+    # entropy and spawn key of a seed (see new_ensemble_state), as they are stored in a checkpoint
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return json.loads(json.dumps({'entropy': seed_seq.entropy, 'spawn_key': list(seed_seq.spawn_key)},
+                                 default=lambda value: value.tolist()))
+
+def load_checkpoint(path):
+    '''
+    loads the state of an ensemble saved by save_checkpoint, after checking that it was saved with the current
+    values of the global variables that define the model and the current contact network (ValueError if not)
+    '''
+    with np.load(path) as data:
+        if str(data['network']) != ('' if network is None else network['key']):
+            raise ValueError(f'{path} was saved with a different contact network')
+        saved = json.loads(str(data['params']))
+        changed = sorted(name for name in set(saved) | set(params_record()) if saved.get(name) != params_record().get(name))
+        if changed:
+            raise ValueError(f'{path} was saved with other values of {", ".join(changed)}: ' +
+                             ', '.join(f'{name} = {saved.get(name)}' for name in changed))
+        
+        seed = json.loads(str(data['seed']))
+        rng = np.random.default_rng()
+        rng.bit_generator.state = json.loads(str(data['rng']))
+        bounds = np.cumsum(data['calendar_sizes'])[:-1]
+        calendar = {int(day): [part] for day, part in zip(data['calendar_days'], np.split(data['calendar_index'], bounds))}
+        return {'t': int(data['t']),
+                'pop': data['pop'],
+                'calendar': calendar,
+                'alive': {'index': data['alive_index'], 'position': data['alive_position'], 'count': data['alive_count']},
+                'counts': data['counts'],
+                'results': list(data['results']),
+                'seed': np.random.SeedSequence(seed['entropy'], spawn_key=seed['spawn_key']),
+                'rng': rng,
+                'keys': data['keys'] if data['crn'] else None}
+
+"""# Parallel Realizations"""
+
+# global variables that define the model
+param_names = ['n', 'nc1_lam', 'nc2_lam', 'incubate_time', 'min_infect', 'max_infect', 'p_e', 'p_i', 'p_f',
+               'incubate_shape', 'infect_shape']
+
+def get_params():
+    # returns the current values of the global variables that define the model
+    return {name: globals()[name] for name in param_names}
+
+def set_params(params):
+    # sets the global variables that define the model (p_u follows p_i)
+    global p_u
+    globals().update(params)
+    p_u = 1 - p_i
+
+def run_realizations(n_realizations, seed=None, workers=None, params=None, crn=False):
+    '''
+    runs n_realizations of simulate1D_vec on a pool of worker processes and returns their
+    (tt, results) in order
+    
+    Every realization draws from its own np.random.Generator, seeded by its own child of
+    np.random.SeedSequence(seed), so the results are bit-identical no matter how many workers
+    are used or in which order they finish.
+    Inputs: seed: entropy of the SeedSequence (None for fresh entropy)
+            workers: number of worker processes (None for one per core, 1 to run in this process)
+            params: values of the global variables to simulate with (default: their current values)
+            crn: whether to use common random numbers (see simulate_ensemble)
+    '''
+    return list(iter_realizations(n_realizations, seed, workers, params, crn))
+
+def iter_realizations(n_realizations, seed=None, workers=None, params=None, crn=False):
+    # same as run_realizations, but yields the realizations one at a time instead of keeping them all
+    params = get_params() if params is None else params
+    tasks = [(params, seed_seq, crn) for seed_seq in np.random.SeedSequence(seed).spawn(n_realizations)]
+    return map_tasks(run_realization, tasks, workers)
+
+def map_tasks(function, tasks, workers=None):
+    '''
+    yields function(task) for each task (e.g. a (params, seed, crn) task), in order, computed on a pool of `workers`
+    processes (None for one per core, 1 to run in this process)
+    '''
+    if workers == 1:
+        saved = get_params()
+        try:
+            for task in tasks:
+                yield function(task)
+        finally:
+            set_params(saved)
+        return
+    
+    # worker processes are forked so that they inherit the functions defined in the notebook
+    workers = workers or multiprocessing.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        yield from executor.map(function, tasks, chunksize=max(1, len(tasks) // (4*workers)))
+
+def run_realization(task):
+    # runs one realization of simulate1D_vec for a (params, seed, crn) task of run_realizations
+    params, seed, crn = task
+    set_params(params)
+    return simulate1D_cached(seed, crn)
+
+"""## Result Cache
+
+Seeded results are stored in `cache_dir` as compressed `.npz` files, named by a hash of the model variant, the global
+variables that define the model, the seed and `cache_version`, so a result is only ever computed once. When the cache
+grows beyond `cache_max_bytes`, the least recently used results are evicted. Set `cache_dir = None` to turn the cache
+off.
+
+`cache_version` has to be increased by every change to the engines that changes which numbers they draw or what they
+return for a seed, so that results of the old code are never read back for the new one.
+"""
+
+cache_dir = os.path.join('.cache', 'simulations') # directory of the result cache
+cache_max_bytes = 2**30 # size limit of the result cache (1 GB)
+cache_version = 1 # version of the engines and of the cached results, see above
+cache_bytes = None # running size of the result cache, as known to this process (None until it is first scanned)
+
+def simulate1D_cached(seed=None, crn=False):
+    # simulate1D_vec, read from the result cache if it has already been run with this seed and these parameters
+    variant = 'simulate1D_crn' if crn else 'simulate1D_vec'
+    results = cached_call(variant, seed, lambda: {'results': np.array(simulate1D_vec(seed, crn=crn)[1])})['results']
+    return list(range(len(results))), results.tolist()
+
+def cache_key(variant, seed):
+    '''
+    content address of a result: sha256 of the cache version, the model variant, the values of the global
+    variables that define the model, the contact network and the seed (an int or a np.random.SeedSequence)
+    '''
+    if isinstance(seed, np.random.SeedSequence):
+        seed = [seed.entropy, list(seed.spawn_key)]
+    content = {'version': cache_version,
+               'variant': variant,
+               'params': {name: float(value) for name, value in get_params().items()},
+               'seed': seed}
+    if network is not None:
+        content['network'] = network['key']
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def cached_call(variant, seed, compute):
+    '''
+    returns the dictionary of arrays computed by compute(), reading it from the result cache if it was
+    already computed for this variant, these parameters and this seed, and storing it otherwise
+    unseeded results cannot be reproduced, so they are always computed
+    the cache is only scanned for eviction when the running size of what this process has written (since its
+    last scan) takes it beyond cache_max_bytes, so several processes writing at once can briefly overshoot it
+    '''
+    global cache_bytes
+    if cache_dir is None or seed is None:
+        return compute()
+    
+    path = os.path.join(cache_dir, cache_key(variant, seed) + '.npz')
+    try:
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        os.utime(path) # mark as recently used
+        return arrays
+    except (OSError, ValueError, zipfile.BadZipFile): # not cached yet (or a corrupt entry)
+        pass
+    
+    arrays = compute()
+    
+    # write to a temporary file first, so that other processes never read a partial entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.savez_compressed(file, **arrays)
+    os.replace(tmp_path, path)
+    size = os.path.getsize(path)
+    if cache_bytes is None or cache_bytes + size > cache_max_bytes:
+        cache_bytes = evict_cache()
+    else:
+        cache_bytes += size
+    return arrays
+
+def evict_cache(max_bytes=None):
+    # removes the least recently used results until the cache is no larger than max_bytes (default cache_max_bytes),
+    # and returns its size
+    max_bytes = cache_max_bytes if max_bytes is None else max_bytes
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npz'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError: # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
+
+"""## Ensemble Statistics
+
+Realizations are aggregated one at a time: the running mean and variance of every day and compartment are updated
+with Welford's algorithm, and selected quantiles are tracked with the P² algorithm (five markers per quantile), so the
+memory used does not depend on the number of realizations. As in the padded averages, a realization that ends before
+the longest one so far counts with its last census for the remaining days; when a longer one arrives, the new days
+start from the statistics of the last censuses of all realizations before it.
+"""
+
+def new_ensemble_stats(quantiles=(0.05, 0.5, 0.95)):
+    # empty streaming statistics of an ensemble, tracking the given quantiles
+    quantiles = np.asarray(quantiles, dtype=float)
+    return {'count': 0, # number of realizations added
+            'quantiles': quantiles,
+            'increments': np.stack([np.zeros_like(quantiles), quantiles/2, quantiles, (1 + quantiles)/2,
+                                    np.ones_like(quantiles)], axis=-1), # P² desired position increments
+            'desired': None, # P² desired marker positions, shared by every day and compartment
+            'days': new_accumulator((0, 6), len(quantiles)), # statistics of each day and compartment
+            'final': new_accumulator((6,), len(quantiles))} # statistics of the last census of each realization
+
+def new_accumulator(shape, n_quantiles):
+    # Welford and P² state of an array of the given shape
+    return {'mean': np.zeros(shape),
+            'm2': np.zeros(shape),
+            'heights': np.zeros(shape + (n_quantiles, 5)), # P² marker heights (the first observations until there are 5)
+            'positions': np.zeros(shape + (n_quantiles, 5))} # P² marker positions
+
+def add_realization(stats, results):
+    '''
+    adds one realization's results (T x 6 censuses) to the streaming statistics, extending the
+    horizon of the statistics if the realization is longer than every realization before it
+    '''
+    results = np.asarray(results, dtype=float)
+    days, final = stats['days'], stats['final']
+    horizon = len(days['mean'])
+    
+    # extend the horizon: before this realization, every realization was on its last census on the new days
+    if len(results) > horizon:
+        new_days = len(results) - horizon
+        for name in days:
+            days[name] = np.concatenate([days[name], np.repeat(final[name][None], new_days, axis=0)])
+        horizon = len(results)
+    
+    # pad the realization with its last census
+    padded = np.empty((horizon, 6))
+    padded[:len(results)] = results
+    padded[len(results):] = results[-1]
+    
+    stats['count'] += 1
+    count = stats['count']
+    if count > 5:
+        stats['desired'] += stats['increments']
+    elif count == 5:
+        stats['desired'] = 1 + 4*stats['increments']
+    update_accumulator(days, padded, count, stats['desired'])
+    update_accumulator(final, results[-1], count, stats['desired'])
+
+def update_accumulator(acc, x, count, desired):
+    # adds the count-th observation x to a Welford and P² accumulator
+    delta = x - acc['mean']
+    acc['mean'] += delta / count
+    acc['m2'] += delta * (x - acc['mean'])
+    
+    h, pos = acc['heights'], acc['positions']
+    x = np.broadcast_to(x[..., None], h.shape[:-1]) # the same observation for every quantile
+    
+    # the first five observations are kept as they are, and become the sorted initial markers
+    if count <= 5:
+        h[..., count-1] = x
+        if count == 5:
+            h.sort(axis=-1)
+            pos[...] = np.arange(1, 6)
+        return
+    
+    # extreme markers follow the minimum and maximum, and the markers above x move up one position
+    np.minimum(h[..., 0], x, out=h[..., 0])
+    np.maximum(h[..., 4], x, out=h[..., 4])
+    pos[..., 1:4] += x[..., None] < h[..., 1:4]
+    pos[..., 4] += 1
+    
+    # move the middle markers that are off their desired positions by one position, adjusting their heights
+    # with the piecewise-parabolic formula (or linearly if that would take them past their neighbours)
+    for i in range(1, 4):
+        d = desired[:, i] - pos[..., i]
+        up = (d >= 1) & (pos[..., i+1] - pos[..., i] > 1)
+        down = (d <= -1) & (pos[..., i-1] - pos[..., i] < -1)
+        s = np.where(up, 1.0, -1.0)
+        
+        parabolic = h[..., i] + s / (pos[..., i+1] - pos[..., i-1]) * (
+            (pos[..., i] - pos[..., i-1] + s) * (h[..., i+1] - h[..., i]) / (pos[..., i+1] - pos[..., i])
+            + (pos[..., i+1] - pos[..., i] - s) * (h[..., i] - h[..., i-1]) / (pos[..., i] - pos[..., i-1]))
+        h_next = np.where(up, h[..., i+1], h[..., i-1])
+        pos_next = np.where(up, pos[..., i+1], pos[..., i-1])
+        linear = h[..., i] + s * (h_next - h[..., i]) / (pos_next - pos[..., i])
+        
+        move = up | down
+        height = np.where((h[..., i-1] < parabolic) & (parabolic < h[..., i+1]), parabolic, linear)
+        h[..., i] = np.where(move, height, h[..., i])
+        pos[..., i] += np.where(move, s, 0)
+
+def ensemble_summary(stats):
+    '''
+    returns the timesteps and a dictionary with the T x 6 mean, variance and standard deviation
+    of the ensemble, and its Q x T x 6 quantiles (all NaN for an ensemble without realizations)
+    '''
+    days, count = stats['days'], stats['count']
+    variance = days['m2'] / (count - 1) if count > 1 else np.zeros_like(days['m2'])
+    if count == 0:
+        nan = np.full_like(days['mean'], np.nan)
+        return list(range(len(nan))), {'mean': nan, 'var': nan.copy(), 'std': nan.copy(),
+                                       'quantiles': np.stack([nan] * len(stats['quantiles']))}
+    if count >= 5:
+        quantiles = np.moveaxis(days['heights'][..., 2], -1, 0)
+    else: # too few realizations for the markers, use the observations themselves
+        quantiles = np.stack([np.quantile(days['heights'][..., k, :count], q, axis=-1)
+                              for k, q in enumerate(stats['quantiles'])])
+    return list(range(len(days['mean']))), {'mean': days['mean'], 'var': variance, 'std': np.sqrt(variance),
+                                            'quantiles': quantiles}
+
+def ensemble_stats(n_realizations, seed=None, workers=None, quantiles=(0.05, 0.5, 0.95)):
+    '''
+    streams n_realizations realizations from iter_realizations (seed and workers are passed on to it)
+    through the ensemble statistics, and returns their ensemble_summary
+    '''
+    stats = new_ensemble_stats(quantiles)
+    for tt, results in iter_realizations(n_realizations, seed=seed, workers=workers):
+        add_realization(stats, results)
+    return ensemble_summary(stats)
+
+"""## Sensitivity Sweeps
+
+Starting from a single infection, many realizations fade out within a few days. They end as soon as no one is 'e',
+'i', or 'u' any more, so they are cheap, but averaging them with the major outbreaks gives means that describe neither.
+Every realization is therefore classified as a major outbreak if the epidemic reached `major_threshold` cumulative
+infections (n - S) before it faded out, and as a minor one otherwise.
+"""
+
+major_threshold = None # cumulative infections of a major outbreak (None for 1% of the population, at least 10)
+
+def is_major(results):
+    # whether one realization's results (censuses until the epidemic faded out) are a major outbreak
+    population = sum(results[-1])
+    threshold = max(10, population // 100) if major_threshold is None else major_threshold
+    return bool(population - results[-1][0] >= threshold)
+
+def summarize_realization(results):
+    '''
+    peak times and peak sizes of the E, I, and U populations, final sizes of the S, R, and F
+    populations, duration of one realization's results, and whether it is a major outbreak
+    '''
+    S, E, I, U, R, F = np.transpose(results)
+    summary = {}
+    for label, y_arr in zip(['E', 'I', 'U'], [E, I, U]):
+        summary['peak_time_' + label] = int(np.argmax(y_arr))
+        summary['peak_' + label] = int(np.max(y_arr))
+    for label, y_arr in zip(['S', 'R', 'F'], [S, R, F]):
+        summary['final_' + label] = int(y_arr[-1])
+    summary['duration'] = len(results) - 1
+    summary['major'] = is_major(results)
+    return summary
+
+def run_summary(task):
+    # runs one realization for a (params, seed, crn) task and returns its summarize_realization
+    return summarize_realization(run_realization(task)[1])
+
+def parameter_grid(grid, mode='single'):
+    '''
+    turns a dictionary of parameter name -> list of values into a list of grid points, each a
+    dictionary of the global variables to change
+    mode 'single' varies one parameter at a time, keeping the others at their current values
+    mode 'product' takes every combination of the values (Cartesian product)
+    '''
+    if mode == 'single':
+        return [{name: value} for name, values in grid.items() for value in values]
+    if mode == 'product':
+        names = list(grid)
+        return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    raise ValueError(f"mode must be 'single' or 'product', not {mode!r}")
+
+def sweep(grid, n_realizations=100, mode='single', seed=None, workers=None, path=None, crn=False, targets=None):
+    '''
+    runs n_realizations realizations at every point of parameter_grid(grid, mode), all of them on one
+    pool of worker processes, and returns one tidy table with a row per grid point and realization:
+    the values of the global variables that define the model, the realization number, and the
+    summarize_realization of its results
+    
+    If path is given, the table is stored there as a CSV file, extended as each grid point finishes,
+    and grid points already in it are skipped, so an interrupted sweep resumes where it stopped.
+    The realizations of a grid point are seeded from the child of SeedSequence(seed) at the position
+    of the point in the grid, so a resumed sweep gives the same table as an uninterrupted one.
+    The settings of the sweep (seed, n_realizations, crn, targets and the contact network) are stored
+    next to it in path + '.json', and resuming a table with other settings raises a ValueError instead
+    of mixing incompatible rows (with seed=None, the sweep resumes with the seed of the table).
+    
+    With crn=True, realization k of every grid point uses the same common random numbers (see simulate_ensemble),
+    seeded from the k-th child of SeedSequence(seed), so the differences between grid points are measured
+    realization by realization instead of being buried in the noise of independent realizations.
+    
+    With targets (see adaptive_ensemble), every grid point runs only as many realizations as it needs to meet
+    them, with n_realizations as its budget.
+    '''
+    base = get_params()
+    points = [{**base, **point} for point in parameter_grid(grid, mode)]
+    root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    if path is not None:
+        settings = sweep_settings(root, n_realizations, crn, targets)
+        if os.path.exists(path):
+            try:
+                with open(path + '.json') as file:
+                    saved = json.load(file)
+            except FileNotFoundError:
+                raise ValueError(f'{path} has no settings file {path}.json, so it cannot be resumed')
+            if seed is None:
+                root = np.random.SeedSequence(saved['seed']['entropy'], spawn_key=saved['seed']['spawn_key'])
+                settings['seed'] = saved['seed']
+            changed = sorted(name for name in settings if saved.get(name) != settings[name])
+            if changed:
+                raise ValueError(f'{path} was swept with other settings: ' +
+                                 ', '.join(f'{name} = {saved.get(name)}' for name in changed))
+        else:
+            with open(path + '.json', 'w') as file:
+                json.dump(settings, file)
+    point_seeds = [np.random.SeedSequence(root.entropy) for point in points] if crn else root.spawn(len(points))
+    
+    table = pd.read_csv(path) if path is not None and os.path.exists(path) else pd.DataFrame()
+    done = {point_key(row) for row in table[param_names].to_dict('records')} if len(table) else set()
+    
+    # grid points left to compute (a point listed twice in the grid is computed once)
+    todo = []
+    for point, point_seed in zip(points, point_seeds):
+        if point_key(point) not in done:
+            done.add(point_key(point))
+            todo.append((point, point_seed))
+    
+    if targets is None:
+        tasks = [(point, seed_seq, crn) for point, point_seed in todo for seed_seq in point_seed.spawn(n_realizations)]
+        summaries = map_tasks(run_summary, tasks, workers)
+    
+    for point, point_seed in todo:
+        if targets is None:
+            rows = pd.DataFrame([{**point, 'realization': k, **next(summaries)} for k in range(n_realizations)])
+        else:
+            rows, report = adaptive_ensemble(targets, n_realizations, seed=point_seed, workers=workers, params=point, crn=crn)
+            rows = pd.concat([pd.DataFrame([point]*len(rows)), rows.rename_axis('realization').reset_index()], axis=1)
+        if path is not None:
+            rows.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+        table = pd.concat([table, rows], ignore_index=True)
+    
+    return table
+
+def sweep_settings(root, n_realizations, crn, targets):
+    # settings of a sweep that its table depends on (besides the grid), as they are stored next to the table
+    return json.loads(json.dumps({'seed': seed_record(root), 'n_realizations': n_realizations, 'crn': crn,
+                                  'targets': targets, 'network': '' if network is None else network['key']}))
+
+def point_key(point):
+    # hashable key of the model parameters of a grid point (or table row)
+    return tuple(round(float(point[name]), 12) for name in param_names)
+
+"""## Adaptive Ensembles
+
+Instead of a fixed number of realizations, `adaptive_ensemble` runs realizations in batches until the confidence
+intervals of the means of chosen summary statistics (the columns of `summarize_realization`) are narrower than their
+targets, e.g. `{'peak_I': 20, 'peak_time_I': 2, 'final_F': 5}` for ±20 individuals at the peak of I, ±2 days for its
+time and ±5 fatalities, or until the budget of realizations is used up. With `major_only=True` the statistics are
+those of the major outbreaks only, and with `n_major` it keeps resampling until it has that many major outbreaks; the
+fraction of minor outbreaks estimates the probability that the epidemic goes extinct early.
+"""
+
+def adaptive_ensemble(targets, max_realizations=1000, batch_size=20, confidence=0.95, seed=None, workers=None,
+                      params=None, crn=False, major_only=False, n_major=None):
+    '''
+    runs batches of batch_size realizations (on a pool of `workers` processes, see map_tasks) until the
+    `confidence` intervals of the means of the summary statistics in targets are all at most as wide as
+    the target half-widths (and there are at least n_major major outbreaks, if given), or max_realizations
+    realizations have run
+    with major_only=True, the target statistics and the ensemble statistics are those of the major outbreaks;
+    if none of the realizations is a major outbreak, the targets are not met, the means are NaN, the ensemble
+    is empty (see ensemble_summary) and the extinction probability is 1
+    the k-th realization is seeded by the k-th child of SeedSequence(seed), as in run_realizations, so a
+    larger budget reproduces the realizations of a smaller one
+    returns the table of summarize_realization of every realization and a report with the number of
+    realizations used, whether the targets were met, the means and half-widths of the target statistics,
+    the ensemble_summary of the censuses, the number of major outbreaks and the extinction probability
+    (fraction of minor outbreaks) with the half-width of its normal-approximation confidence interval
+    '''
+    if max_realizations < 1 or batch_size < 1:
+        raise ValueError(f'max_realizations and batch_size must be at least 1, not {max_realizations} and {batch_size}')
+    params = get_params() if params is None else params
+    root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    stats = new_ensemble_stats()
+    rows = []
+    
+    def met(table):
+        # half-widths of the target statistics and whether every target is met
+        sample = table[table['major']] if major_only else table
+        half_width = confidence_half_widths(sample[list(targets)], confidence)
+        return half_width, bool((half_width <= pd.Series(targets, dtype=float)).all()
+                                and (n_major is None or table['major'].sum() >= n_major))
+    
+    while len(rows) < max_realizations:
+        tasks = [(params, seed_seq, crn) for seed_seq in root.spawn(min(batch_size, max_realizations - len(rows)))]
+        for tt, results in map_tasks(run_realization, tasks, workers):
+            rows.append(summarize_realization(results))
+            if rows[-1]['major'] or not major_only:
+                add_realization(stats, results)
+        
+        half_width, converged = met(pd.DataFrame(rows))
+        if converged:
+            break
+    
+    table = pd.DataFrame(rows)
+    sample = table[table['major']] if major_only else table
+    extinction = 1 - table['major'].mean()
+    report = {'n_realizations': len(rows),
+              'converged': converged,
+              'mean': sample[list(targets)].mean(),
+              'half_width': half_width,
+              'ensemble': ensemble_summary(stats),
+              'n_major': int(table['major'].sum()),
+              'extinction_probability': extinction,
+              'extinction_half_width': ndtri((1 + confidence) / 2) * np.sqrt(extinction * (1 - extinction) / len(rows))}
+    return table, report
+
+def confidence_half_widths(table, confidence=0.95):
+    # half-widths of the student t confidence intervals of the means of the columns of table
+    count = len(table)
+    if count < 2:
+        return pd.Series(np.inf, index=table.columns)
+    return table.std() / np.sqrt(count) * stdtrit(count - 1, (1 + confidence) / 2)
+
+"""## Scenario Forks
+
+Interventions usually start some time into the epidemic, e.g. social distancing (a lower `nc1_lam`) from day 30 on.
+`fork_ensemble` simulates the days before the intervention once, and continues copies of that ensemble with the
+parameters of every branch. The copies share the calendar and the censuses of the common prefix, and only copy the
+arrays that change in place; on a pool of worker processes, the forked workers share the snapshot copy-on-write. Every
+branch also starts from the same state of the random number generator, so the branches differ by their parameters and
+not by chance until the branch day.
+"""
+
+forked_state = None # ensemble state on the branch day, shared with the worker processes of fork_ensemble
+
+def copy_state(state):
+    '''
+    copy of an ensemble state (see new_ensemble_state) that can be advanced without changing the original:
+    the arrays that change in place (the state matrix, the running counts and the alive set) and the random
+    number generator are copied, while the index arrays in the calendar, which never change in place, and the
+    censuses so far are shared
+    '''
+    rng = np.random.default_rng()
+    rng.bit_generator.state = state['rng'].bit_generator.state
+    return {'t': state['t'],
+            'pop': state['pop'].copy(),
+            'calendar': {day: list(bucket) for day, bucket in state['calendar'].items()},
+            'alive': {name: np.copy(value) for name, value in state['alive'].items()},
+            'counts': state['counts'].copy(),
+            'results': list(state['results']),
+            'seed': state['seed'],
+            'rng': rng,
+            'keys': state['keys']}
+
+def run_branch(params):
+    # continues a copy of forked_state with the global variables params until the epidemics are over
+    set_params(params)
+    state = advance_ensemble(copy_state(forked_state))
+    return list(range(state['t'] + 1)), np.stack(state['results'], axis=1)
+
+def fork_ensemble(n_realizations, branch_day, branches, seed=None, workers=None, crn=False):
+    '''
+    simulates n_realizations realizations (see simulate_ensemble, with seed and crn) with the current values of
+    the global variables until branch_day, and continues them once for every branch: a dictionary of branch
+    names and the global variables that change from the branch day on, e.g. {'baseline': {}, 'distancing':
+    {'nc1_lam': 1}}; the branches run on a pool of `workers` processes (see map_tasks)
+    returns a dictionary of branch names and the (tt, results) of simulate_ensemble of every branch, the
+    first branch_day days of which are the same for all of them
+    '''
+    global forked_state
+    base = get_params()
+    forked_state = advance_ensemble(new_ensemble_state(n_realizations, seed=seed, crn=crn), until=branch_day)
+    try:
+        return dict(zip(branches, map_tasks(run_branch, [{**base, **changes} for changes in branches.values()], workers)))
+    finally:
+        forked_state = None
+
+"""# Sensitivity Testing"""
 
 # GLOBAL VARIABLES
 n = 10000 # population
@@ -537,9 +1866,45 @@ p_i = 0.484   # prob of becoming symptomatic / infected
 p_u = 1 - p_i # prob of becoming asymptomatic (undetected)
 p_f = 2.6605/100    # prob of a fatality (assuming only symptomatic individuals may die)
 
+# shapes of the duration distributions of the vectorized engine (0 for the constant incubate_time and the uniform
+# min_infect to max_infect days above, k > 0 for a gamma distribution with the same mean, an Erlang distribution for integer k)
+incubate_shape = 0
+infect_shape = 0
+
+network = None # contact network of the n individuals for the vectorized engine (None for uniform mixing), see Contact Networks
+
 pd.set_option("display.max_rows", None, "display.max_columns", None)
 
-# change title before running function
-for lam in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
-    nc1_lam = lam
-    display(plot_average_over_realizations(100, parameter = 'lambda'))
\ No newline at end of file
+# sweep p_e, p_i, p_f, and nc1_lam one at a time around the values above; the table is kept in
+# sensitivity.csv, so re-running this cell only computes grid points that are not in it yet
+probs = [0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]
+sensitivity = sweep({'p_e': probs,
+                     'p_i': probs,
+                     'p_f': [prob/5 for prob in probs],
+                     'nc1_lam': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]},
+                    n_realizations=100, seed=0, path='sensitivity.csv')
+
+# average peak times, peak sizes and final sizes at each grid point
+display(sensitivity.drop(columns='realization').groupby(param_names).mean().round(2))
+
+# with p_e = 0 (the first p_e of the grid) every outbreak is minor, so an ensemble of the major outbreaks is empty
+table, report = adaptive_ensemble({'peak_I': 30}, 10, batch_size=5, seed=0, params={**get_params(), 'p_e': 0},
+                                  major_only=True)
+assert report['n_major'] == 0 and not report['converged'] and report['extinction_probability'] == 1
+assert np.isnan(report['mean']['peak_I']) and len(report['ensemble'][0]) == 0
+
+"""# Interventions"""
+
+# social distancing from day 30 on, continued from the same first 30 days of 100 realizations
+interventions = fork_ensemble(100, 30, {'baseline': {},
+                                        r'$\lambda_1$ = 1.2': {'nc1_lam': 1.2},
+                                        r'$\lambda_1$ = 0.8': {'nc1_lam': 0.8}}, seed=0)
+
+plt.figure()
+for label, (tt, results) in interventions.items():
+    plt.plot(tt, results[:, :, I_CODE].mean(axis=0), label=label)
+plt.axvline(30, color='k', linestyle='--')
+plt.title('Social Distancing from Day 30')
+plt.xlabel('Time (days)')
+plt.ylabel('Infected (average)')
+plt.legend()